@@ -0,0 +1,242 @@
+""" Benchmark of the /daten/ view: synchronous WSGI path against the asynchronous ASGI path.
+
+A mixed workload of cold places (station data still to be downloaded), hot
+places (payload in the cache) and autocomplete queries arrives at once.
+
+- WSGI: one synchronous worker (like a gunicorn sync worker) serves the requests one after another.
+- ASGI: one event loop serves all requests concurrently with the daten_async view.
+
+The DWD server is replaced by a local HTTP server with a fixed latency which
+serves the locally cached stations as zip files, so the benchmark runs offline.
+
+    python benchmarks/daten_wsgi_asgi.py --cold 12 --hot 60 --autocomplete 60 --latency 1.0
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.core.handlers.asgi import ASGIHandler  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.urls import include, path  # noqa: E402
+
+from wetter import views  # noqa: E402
+from wetter.lib.dwd import DWD, DwdFile, SharedStore  # noqa: E402
+
+urlpatterns = [
+    path("wsgi/daten/<geo>/<monattag>/", views.daten),
+    path("asgi/daten/<geo>/<monattag>/", views.daten_async),
+    path("", include("wetter.urls")),
+]
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wetter", "data")
+QUERIES = ["Aach", "Berl", "Dres", "Flens", "Koeln", "Muen", "Ham", "520", "0106", "Stutt"]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.server.files.get(self.path.rsplit("/", 1)[-1], b"")
+        self.send_response(200 if body else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def zip_station(stations_id: int) -> tuple:
+    """Return the name and content of a zip file in the format of the DWD with the cached data."""
+    shortname = str(stations_id).zfill(5)
+    df = pd.read_csv(os.path.join(DATA_DIR, "station_data", shortname + ".csv.gz"))
+    von, bis = df.MESS_DATUM.iloc[0], df.MESS_DATUM.iloc[-1]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(
+            "produkt_klima_tag_{}_{}_{}.txt".format(von, bis, shortname),
+            df.to_csv(sep=";", index=False, na_rep="-999"))
+    return "tageswerte_KL_{}_{}_{}_hist.zip".format(shortname, von, bis), buffer.getvalue()
+
+
+def prepare(tmp_dir: str, latency: float, cold_share: float):
+    """Serve the cached stations and split them into local (hot) and remote (cold) ones."""
+    ids = []
+    for filename in sorted(os.listdir(os.path.join(DATA_DIR, "station_data"))):
+        if filename.endswith(".csv.gz") and os.path.getsize(os.path.join(DATA_DIR, "station_data", filename)) > 100:
+            ids.append(int(filename[0:5]))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.latency = latency
+    server.files = dict(zip_station(x) for x in ids)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.makedirs(os.path.join(tmp_dir, "data"))
+    with open(os.path.join(tmp_dir, "data", "filelist.txt"), "w") as f:
+        f.write("\n".join(sorted(server.files)) + "\n")
+    random.seed(1)
+    cold = set(random.sample(ids, int(len(ids) * cold_share)))
+    return server, ids, cold
+
+
+def reset_store(tmp_dir: str, ids: list, cold: set) -> None:
+    """Copy the hot stations into an empty store."""
+    station_data = os.path.join(tmp_dir, "data", "station_data")
+    shutil.rmtree(station_data, ignore_errors=True)
+    os.makedirs(station_data)
+    for x in ids:
+        if x not in cold:
+            shutil.copy(os.path.join(DATA_DIR, "station_data", str(x).zfill(5) + ".csv.gz"), station_data)
+    cache.clear()
+
+
+def make_workload(ids: list, cold: set, args) -> list:
+    """Return the requests as (kind, path) in order of arrival."""
+    stations = {x.stations_id: x for x in DWD().get_station_tuple()}
+    hot_places, cold_places = [], []
+    for x in ids:
+        geo = "{},{}".format(stations[x].geo_breite, stations[x].geo_laenge)
+        nearest = {e.stations_id for e in DWD().nearest(stations[x].geo_breite, stations[x].geo_laenge, 100, 3)}
+        (cold_places if nearest & cold else hot_places).append(geo)
+    requests = [("cold", "daten/{}/0704/".format(x)) for x in cold_places[0:args.cold]]
+    requests += [("hot", "daten/{}/0704/".format(random.choice(hot_places))) for i in range(args.hot)]
+    requests += [("autocomplete", "plz/?query=" + random.choice(QUERIES)) for i in range(args.autocomplete)]
+    random.shuffle(requests)
+    return requests, hot_places
+
+
+def warm_up(client, prefix: str, hot_places: list) -> None:
+    for geo in hot_places:
+        client.get("/{}daten/{}/0704/".format(prefix, geo))
+
+
+def run_wsgi(requests: list) -> list:
+    """One synchronous worker, the requests wait in a queue."""
+    client = Client()
+    start = time.perf_counter()
+    latencies = []
+    for kind, url in requests:
+        response = client.get("/" + (url if kind == "autocomplete" else "wsgi/" + url))
+        assert response.status_code == 200
+        latencies.append((kind, time.perf_counter() - start))
+    return latencies
+
+
+async def asgi_get(application, url: str) -> int:
+    """Send a GET request to the ASGI application like an ASGI server and return the status."""
+    path_, _, query = url.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path_, "root_path": "", "query_string": query.encode(),
+        "headers": [(b"host", b"localhost")], "client": ("127.0.0.1", 1), "server": ("localhost", 80),
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    complete = asyncio.Event()
+    status = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+        elif not message.get("more_body"):
+            complete.set()
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+async def run_asgi(requests: list) -> list:
+    """One event loop, all requests concurrently."""
+    application = ASGIHandler()
+    start = time.perf_counter()
+
+    async def get(kind, url):
+        status = await asgi_get(application, "/" + (url if kind == "autocomplete" else "asgi/" + url))
+        assert status == 200
+        return kind, time.perf_counter() - start
+
+    return await asyncio.gather(*[get(kind, url) for kind, url in requests])
+
+
+def summarize(latencies: list) -> dict:
+    total = max(x[1] for x in latencies)
+    result = {"requests": len(latencies), "seconds": round(total, 3), "throughput": round(len(latencies) / total, 1)}
+    for kind in ["cold", "hot", "autocomplete"]:
+        values = np.array([x[1] for x in latencies if x[0] == kind])
+        if len(values):
+            result[kind] = {
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 1),
+                "p95_ms": round(float(np.percentile(values, 95)) * 1000, 1),
+            }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cold", type=int, default=12, help="Number of cold places.")
+    parser.add_argument("--hot", type=int, default=60, help="Number of requests of cached places.")
+    parser.add_argument("--autocomplete", type=int, default=60, help="Number of autocomplete requests.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Latency of the DWD stand-in server (s).")
+    parser.add_argument("--cold-share", type=float, default=0.3, help="Share of stations without local data.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    server, ids, cold = prepare(tmp_dir, args.latency, args.cold_share)
+    results = {}
+    with override_settings(
+            ROOT_URLCONF=__name__,
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}), \
+            mock.patch.object(DwdFile, "module_dir", os.path.join(tmp_dir, "lib")), \
+            mock.patch.object(DwdFile, "base_path", "http://127.0.0.1:{}/".format(server.server_address[1])), \
+            mock.patch.object(SharedStore, "filename", os.path.join(tmp_dir, "station_grids.bin")):
+        reset_store(tmp_dir, ids, cold)
+        requests, hot_places = make_workload(ids, cold, args)
+        warm_up(Client(), "wsgi/", hot_places)
+        results["wsgi"] = summarize(run_wsgi(requests))
+        reset_store(tmp_dir, ids, cold)
+        warm_up(Client(), "asgi/", hot_places)
+        results["asgi"] = summarize(asyncio.run(run_asgi(requests)))
+    server.shutdown()
+    shutil.rmtree(tmp_dir)
+
+    for mode, result in results.items():
+        print("{:5} {:4d} requests in {:7.3f} s, {:6.1f} req/s".format(
+            mode, result["requests"], result["seconds"], result["throughput"]))
+        for kind in ["cold", "hot", "autocomplete"]:
+            if kind in result:
+                print("      {:13} p50 {:8.1f} ms  p95 {:8.1f} ms".format(
+                    kind, result[kind]["p50_ms"], result[kind]["p95_ms"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+""" Benchmark suite of the Forecast pipeline.
+
+Every stage runs a number of times and reports latency percentiles, the peak
+memory allocated during one run (tracemalloc) is measured in separate runs, so
+the tracing does not slow down the timed runs. The suite runs offline:
+either on a copy of the bundled station data and the JSON files or on a
+synthetic data set of many stations with long histories, both in a temporary
+directory, so the working tree stays untouched.
+
+    python benchmarks/forecast_suite.py --json results/HEAD.json
+    python benchmarks/forecast_suite.py --synthetic 2000 --years 150 --repeat 5
+    python benchmarks/forecast_suite.py --synthetic 2000 --stations 20 --weighting idw --hoehe 300
+    python benchmarks/forecast_suite.py --compare results/before.json results/after.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from wetter.lib.dwd import (  # noqa: E402
+    DWD, DwdFile, DwdStation, Forecast, JsonFiles, Plz, SharedStore, StationCache, VARIABLES)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BASE_DIR, "wetter", "data")
+PLACES = [(50.77, 6.08), (52.52, 13.40), (51.05, 13.73), (54.80, 9.42)]  # places with bundled data
+QUERIES = ["Aach", "Berl", "52062", "Dres", "0106", "Flens", "Koeln", "Muen"]
+
+
+class Synthetic():
+    """Generate stations with daily data in the layout of the DWD data files."""
+
+    def __init__(self, path: str, stations: int, years: int, seed: int = 1):
+        self.path = path
+        self.random = np.random.default_rng(seed)
+        self.stations = stations
+        self.years = years
+        os.makedirs(os.path.join(path, "data", "station_data"))
+
+    def make_frame(self, stations_id: int, first_year: int) -> pd.DataFrame:
+        """Return daily values with a seasonal cycle, noise and gaps."""
+        dates = pd.date_range(datetime.date(first_year, 1, 1), datetime.date(first_year + self.years - 1, 12, 31))
+        season = np.cos((dates.dayofyear.to_numpy() - 200) / 365.25 * 2 * np.pi)
+        n = len(dates)
+        noise = self.random.standard_normal((n, len(VARIABLES)))
+        data = {
+            "STATIONS_ID": np.full(n, stations_id),
+            "MESS_DATUM": dates.strftime("%Y%m%d").astype(int),
+            "TXK": np.round(14 + 10 * season + 4 * noise[:, 0], 1),
+            "TNK": np.round(5 + 8 * season + 3 * noise[:, 1], 1),
+            "RSK": np.round(np.maximum(0, 2 * noise[:, 2]), 1),
+            "SDK": np.round(np.clip(5 + 4 * season + 3 * noise[:, 3], 0, 16), 1),
+            "PM": np.round(1013 + 8 * noise[:, 4], 1),
+            "UPM": np.round(np.clip(78 - 10 * season + 8 * noise[:, 5], 20, 100), 1),
+        }
+        df = pd.DataFrame(data)
+        for col in VARIABLES:  # gaps of missing measurements
+            df.loc[self.random.random(n) < 0.02, col] = np.NaN
+        df.loc[df.MESS_DATUM < (first_year + self.years // 2) * 10000, "SDK"] = np.NaN  # sunshine recorded later
+        return df
+
+    def build(self) -> None:
+        """Write stations.json, filelist.txt and the columnar store of all stations."""
+        dwdfile = DwdFile()
+        dwdfile.module_dir = os.path.join(self.path, "data")
+        stations, filelist = [], []
+        last_year = 2020
+        for i in range(self.stations):
+            stations_id = i + 1
+            first_year = last_year - self.years + 1
+            von, bis = first_year * 10000 + 101, last_year * 10000 + 1231
+            stations.append({
+                "Stations_id": stations_id, "von_datum": von, "bis_datum": bis,
+                "Stationshoehe": int(self.random.integers(0, 1500)),
+                "geoBreite": "{:.4f}".format(self.random.uniform(47.3, 55.0)),
+                "geoLaenge": "{:.4f}".format(self.random.uniform(5.9, 15.0)),
+                "Stationsname": "Station {}".format(stations_id), "Bundesland": "Synthetien"
+            })
+            filelist.append("tageswerte_KL_{}_{}_{}_hist.zip".format(str(stations_id).zfill(5), von, bis))
+            dwdfile.write_store(stations_id, self.make_frame(stations_id, first_year))
+        with open(os.path.join(self.path, "data", "stations.json"), "w") as f:
+            json.dump(stations, f)
+        with open(os.path.join(self.path, "data", "filelist.txt"), "w") as f:
+            f.write("\n".join(filelist) + "\n")
+
+    def places(self, count: int) -> list:
+        """Return random places within the area of the stations."""
+        return [(self.random.uniform(47.5, 54.8), self.random.uniform(6.1, 14.8)) for i in range(count)]
+
+    def patches(self) -> list:
+        """Return the patches which make the application use the synthetic data."""
+        filename = os.path.join(self.path, "data", "stations.json")
+        return [
+            mock.patch.object(DwdFile, "module_dir", os.path.join(self.path, "lib")),
+            mock.patch.object(DWD, "get_station_tuple", lambda self: JsonFiles().get(
+                filename, lambda list_: tuple(DwdStation(e) for e in list_))),
+        ]
+
+
+def copy_bundled(path: str) -> None:
+    """Copy filelist.txt and the csv.gz files of the bundled stations, the stores are written next to the copies."""
+    os.makedirs(os.path.join(path, "data", "station_data"))
+    shutil.copy(os.path.join(DATA_DIR, "filelist.txt"), os.path.join(path, "data"))
+    for filename in os.listdir(os.path.join(DATA_DIR, "station_data")):
+        if filename.endswith(".csv.gz"):
+            shutil.copy(os.path.join(DATA_DIR, "station_data", filename), os.path.join(path, "data", "station_data"))
+
+
+def measure(function, repeat: int, warmup: int = 1, memory_runs: int = 3) -> dict:
+    """Run a function repeatedly, return latency percentiles (ms) and the peak of allocated memory (KiB).
+
+    The latencies are timed without tracemalloc, the peak is taken from memory_runs further runs.
+    """
+    for i in range(warmup):
+        function(i)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    peak = 0
+    for i in range(memory_runs):
+        tracemalloc.start()
+        try:
+            function(i)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    ms = np.array(times) * 1000
+    return {
+        "n": repeat,
+        "mean_ms": round(float(ms.mean()), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def get_stages(places: list, tmp_dir: str, k: int = 3, estimation: dict = None) -> dict:
+    """Return the benchmarked stages as functions of the run number.
+
+    k: number of stations per place
+    estimation: keyword arguments of Forecast (weighting, hoehe)
+    """
+    estimation = estimation or {}
+    forecasts = [Forecast(x[0], x[1], 100, "0704", k, **estimation) for x in places]
+    client = Client()
+    store = os.path.join(tmp_dir, "store")
+    os.makedirs(os.path.join(store, "station_data"), exist_ok=True)
+    source = DwdFile()
+    ids = [e.stations_id for fc in forecasts for e in fc.stations if source.get_version(e.stations_id)]
+
+    def store_station(i):
+        dwdfile = DwdFile()
+        dwdfile.module_dir = store
+        df = source.get_data(ids[i % len(ids)])
+        dwdfile.write_store(i, df)
+        dwdfile.get_data(i)
+
+    def view(i, cached):
+        if not cached:
+            cache.clear()
+        geo = places[i % len(places)]
+        assert client.get("/daten/{},{}/0704/".format(*geo)).status_code == 200
+
+    def forecast_uncached(i):
+        StationCache().clear()
+        Forecast(*places[i % len(places)], 100, "0704", k, **estimation)
+
+    def pick(i):
+        return forecasts[i % len(forecasts)]
+
+    return {
+        "nearest": lambda i: DWD().nearest(*places[i % len(places)], 100, k),
+        "forecast_init": lambda i: Forecast(*places[i % len(places)], 100, "0704", k, **estimation),
+        "forecast_init_uncached": forecast_uncached,
+        "filter": lambda i: [pick(i).filter(e, col, "0704") for e in pick(i).stations for col in VARIABLES],
+        "create_timeline": lambda i: [pick(i).create_timeline(col, "0704") for col in VARIABLES],
+        "get_aggregates": lambda i: pick(i).get_aggregates(),
+        "make_history": lambda i: pick(i).make_history(),
+        "aggregate_over_year": lambda i: pick(i).aggregate_over_year(),
+        "aggregates_for_days": lambda i: pick(i).get_aggregates_for_days(pick(i).get_tage("0101", "1231")),
+        "store_station": store_station,
+        "plz_query": lambda i: Plz().query(QUERIES[i % len(QUERIES)]),
+        "daten_view": lambda i: view(i, False),
+        "daten_view_cached": lambda i: view(i, True),
+    }
+
+
+def get_meta(dataset: str) -> dict:
+    """Return the commit, the data set and the versions the results were measured with."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "dataset": dataset,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "django": django.get_version(),
+        "machine": platform.machine(),
+    }
+
+
+def compare(before: dict, after: dict) -> None:
+    """Print the p50 latencies of two result files side by side."""
+    print("{:22} {:>12} {:>12} {:>8}".format("stage", before["meta"]["commit"], after["meta"]["commit"], "ratio"))
+    for stage, result in after["stages"].items():
+        if stage in before["stages"]:
+            old, new = before["stages"][stage]["p50_ms"], result["p50_ms"]
+            print("{:22} {:10.3f}ms {:10.3f}ms {:8.2f}".format(stage, old, new, new / old if old else float("nan")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per stage (default: 20).")
+    parser.add_argument(
+        "--memory-runs", type=int, default=3, help="Runs per stage with tracemalloc for the peak memory (default: 3).")
+    parser.add_argument("--stages", nargs="*", help="Run only these stages.")
+    parser.add_argument("--synthetic", type=int, metavar="STATIONS", help="Use this many synthetic stations.")
+    parser.add_argument("--years", type=int, default=150, help="Years of data per synthetic station.")
+    parser.add_argument("--stations", type=int, default=3, help="Stations per place (default: 3).")
+    parser.add_argument("--weighting", choices=Forecast.weightings, default="mean", help="Weighting of the stations.")
+    parser.add_argument("--hoehe", type=float, help="Correct the values to this height of the places (m), not in the views.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files.")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        stack.enter_context(override_settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}))
+        # the shared file of the working tree would change the results
+        stack.enter_context(mock.patch.object(SharedStore, "filename", os.path.join(tmp_dir, "station_grids.bin")))
+        if args.synthetic:
+            synthetic = Synthetic(tmp_dir, args.synthetic, args.years)
+            start = time.perf_counter()
+            synthetic.build()
+            print("{} synthetic stations with {} years built in {:.1f} s".format(
+                args.synthetic, args.years, time.perf_counter() - start))
+            for patch in synthetic.patches():
+                stack.enter_context(patch)
+            dataset = "synthetic({} stations, {} years)".format(args.synthetic, args.years)
+            places = synthetic.places(8)
+        else:
+            copy_bundled(tmp_dir)
+            stack.enter_context(mock.patch.object(DwdFile, "module_dir", os.path.join(tmp_dir, "lib")))
+            dataset = "bundled"
+            places = PLACES
+        estimation = {"weighting": args.weighting, "hoehe": args.hoehe}
+        stack.enter_context(override_settings(
+            DATEN_STATIONS=args.stations, DATEN_WEIGHTING=args.weighting))
+        results = {}
+        for name, function in get_stages(places, tmp_dir, args.stations, estimation).items():
+            if args.stages and name not in args.stages:
+                continue
+            results[name] = measure(function, args.repeat, memory_runs=args.memory_runs)
+            print("{:22} p50 {p50_ms:10.3f} ms  p90 {p90_ms:10.3f} ms  p99 {p99_ms:10.3f} ms  "
+                  "peak {peak_kib:10.1f} KiB".format(name, **results[name]))
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w") as f:
+            meta = dict(get_meta(dataset), stations=args.stations, memory_runs=args.memory_runs, **estimation)
+            json.dump({"meta": meta, "stages": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
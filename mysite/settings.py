@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 import django_heroku
+import importlib.util
 import os
 
 
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wetter.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +73,22 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'mysite.wsgi.application'
 
+# Serve /daten/ with the asynchronous view (set by mysite/asgi.py)
+ASYNC_DATEN = os.environ.get('ASYNC_DATEN', '') == '1'
+
+# Time the stages of requests: Server-Timing header, log lines and /metrics/
+METRICS = os.environ.get('METRICS', '') == '1'
+
+# Memory budget of the loaded stations per process and the stations loaded at
+# startup (comma separated ids, shared by the workers with gunicorn --preload)
+STATION_CACHE_BYTES = int(os.environ.get('STATION_CACHE_MB', '256')) * 1024 * 1024
+STATION_CACHE_PRELOAD = [int(x) for x in os.environ.get('STATION_CACHE_PRELOAD', '').split(',') if x]
+
+# Estimation of the daten pages: stations per place and their weighting ("mean"
+# or inverse distance "idw")
+DATEN_STATIONS = int(os.environ.get('DATEN_STATIONS', '3'))
+DATEN_WEIGHTING = os.environ.get('DATEN_WEIGHTING', 'mean')
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -101,10 +119,14 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# memcached shares the daten payloads between the processes, without pylibmc
+# every process caches them in its own memory
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
         'LOCATION': '/tmp/memcached.sock',
+    } if importlib.util.find_spec('pylibmc') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -131,3 +153,10 @@ X_FRAME_OPTIONS = '*'
 
 # Activate Django-Heroku.
 django_heroku.settings(locals())
+
+# The WhiteNoise middleware added by django_heroku is synchronous only, it would
+# run the async views of the ASGI entry point in a thread
+MIDDLEWARE = [
+    'wetter.middleware.WhiteNoiseMiddleware' if x == 'whitenoise.middleware.WhiteNoiseMiddleware' else x
+    for x in MIDDLEWARE
+]
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_wsgi_application()
+
+from wetter.lib.dwd import StationCache  # noqa: E402
+
+StationCache().warm(settings.STATION_CACHE_PRELOAD)  # before the fork of the workers with --preload
@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 class WetterConfig(AppConfig):
     name = 'wetter'
+
+    def ready(self):
+        from .lib.dwd import Forecast, StationCache
+        from .lib.metrics import Metrics
+        Metrics.enabled = getattr(settings, "METRICS", False)
+        StationCache.max_bytes = getattr(settings, "STATION_CACHE_BYTES", StationCache.max_bytes)
+        if settings.DATEN_WEIGHTING not in Forecast.weightings:
+            raise ImproperlyConfigured("DATEN_WEIGHTING must be one of {}".format(Forecast.weightings))
@@ -8,23 +8,51 @@ __all__ = []
 __version__ = "0.1"
 __author__ = "U. Jung"
 
+import calendar
+import contextlib
+import copy
 import json
+import mmap
 import os
-import zipfile
 import datetime
 import shutil
+import struct
 import tempfile
+import threading
+import time
+import urllib.error
+from collections import OrderedDict
+from typing import Dict, List
 
-import urllib.request
 from geopy.distance import geodesic
 import numpy as np
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
+from .fetch import StationFetcher
+from .metrics import Metrics, timed
+from .search import SearchIndex
+
+
+VARIABLES = ["TXK", "TNK", "RSK", "SDK", "PM", "UPM"]  # the measurements used by Forecast
+TAGE = [
+    str(m).zfill(2) + str(t).zfill(2)
+    for m in range(1, 13) for t in range(1, calendar.monthrange(2000, m)[1] + 1)
+]  # all days of a leap year as "MMTT"
+TAG_SLOT = np.full(1232, -1, dtype=np.int16)  # "MMTT" as int -> position in TAGE
+TAG_SLOT[[int(x) for x in TAGE]] = np.arange(len(TAGE))
 
 
 class DWD():
     """Prepare a list of weather stations and calculate the distance to the place of interest."""
+
+    index = None  # process-wide StationIndex, built on first use
+    index_sources = (None, None)  # station tuple and filelist the index was built from
+
     def __init__(self):
         """Create instance variables.
         
@@ -35,20 +63,187 @@ class DWD():
         self.module_dir = os.path.dirname(__file__)  
        
     def get_stations(self) -> None:
-        "Open the file which contains the weather station meta data."
-        f = open(os.path.join(self.module_dir, "../data/stations.json"), "r")
-        list_ = json.load(f)
-        f.close()
-        for e in list_:
-            self.stations.append(DwdStation(e))
+        """Open the file which contains the weather station meta data.
+
+        The stations are parsed once per process and shared, do not modify them.
+        """
+        self.stations.extend(self.get_station_tuple())
 
     def get_distance(self, start_point: tuple, end_point: tuple) -> float:
         """Calculate the distance between point (lat,lon) in kilometers."""
         return round(geodesic(start_point, end_point).km, 1)
 
+    def get_index(self) -> "StationIndex":
+        """Return the spatial index of the stations with a data file, build it once per process.
+
+        Stations missing in filelist.txt have no historical data and are left out.
+        The index is rebuilt when stations.json or filelist.txt was reloaded.
+        """
+        stations = self.get_station_tuple()
+        filelist = DwdFile().get_filelist()
+        if DWD.index_sources[0] is not stations or DWD.index_sources[1] is not filelist:
+            DWD.index = StationIndex([x for x in stations if x.stations_id in filelist])
+            DWD.index_sources = (stations, filelist)
+        return DWD.index
+
+    def get_station_tuple(self) -> tuple:
+        """Return the shared tuple of all stations."""
+        return JsonFiles().get(
+            os.path.join(self.module_dir, "../data/stations.json"),
+            lambda list_: tuple(DwdStation(e) for e in list_))
+
+    @timed("nearest")
+    def nearest(self, geo_breite: float, geo_laenge: float, max_distance: float, k: int) -> list:
+        """Return up to k stations within max_distance km, nearest first.
+
+        The stations are copies with the distance set, so callers may attach data to them.
+        """
+        return self.get_stations_at(self.get_index().query(geo_breite, geo_laenge, max_distance, k))
+
+    @timed("nearest")
+    def nearest_many(self, places: list, max_distance: float, k: int) -> List[list]:
+        """Return the nearest stations (like nearest) of many places (geo_breite, geo_laenge)."""
+        return [self.get_stations_at(x) for x in self.get_index().query_many(places, max_distance, k)]
+
+    def get_stations_at(self, found: list) -> list:
+        """Return copies of the indexed stations with the distances found by a query."""
+        index = self.get_index()
+        list_ = []
+        for i, distance in found:
+            station = copy.copy(index.stations[i])
+            station.set_distance(distance)
+            list_.append(station)
+        return list_
+
+
+class StationIndex():
+    """Precomputed station coordinates for nearest neighbour queries.
+
+    A vectorized haversine distance on the mean earth sphere preselects the
+    candidates, only these are measured on the WGS-84 ellipsoid with Vincenty's
+    formula, all candidates at once. It agrees with the geodesic (Karney) to
+    less than a millimeter, the distances rounded to 100 m are the same.
+    """
+
+    earth_radius = 6371.0088
+    tolerance = 1.02  # haversine deviates less than 0.6 % from the geodesic
+    semi_major = 6378.137  # WGS-84 (km)
+    flattening = 1 / 298.257223563
+
+    def __init__(self, stations: list):
+        self.stations = stations
+        breite = np.radians([float(x.geo_breite) for x in stations])
+        self.sin_breite = np.sin(breite)
+        self.cos_breite = np.cos(breite)
+        self.laenge = np.radians([float(x.geo_laenge) for x in stations])
+        reduced = np.arctan((1 - self.flattening) * np.tan(breite))  # latitude on the auxiliary sphere
+        self.sin_reduced = np.sin(reduced)
+        self.cos_reduced = np.cos(reduced)
+
+    def haversine(self, geo_breite: float, geo_laenge: float) -> np.ndarray:
+        """Approximate the distance of all stations to a point in kilometers."""
+        breite = np.radians(geo_breite)
+        cos_angle = (np.sin(breite) * self.sin_breite
+                     + np.cos(breite) * self.cos_breite * np.cos(self.laenge - np.radians(geo_laenge)))
+        return self.earth_radius * np.arccos(np.clip(cos_angle, -1.0, 1.0))
+
+    def vincenty(self, geo: tuple, candidates: np.ndarray, iterations: int = 50) -> np.ndarray:
+        """Return the distances of a point to some stations on the ellipsoid in kilometers."""
+        f = self.flattening
+        semi_minor = self.semi_major * (1 - f)
+        reduced = np.arctan((1 - f) * np.tan(np.radians(geo[0])))
+        sin_u1, cos_u1 = np.sin(reduced), np.cos(reduced)
+        sin_u2, cos_u2 = self.sin_reduced[candidates], self.cos_reduced[candidates]
+        diff = self.laenge[candidates] - np.radians(geo[1])
+        lambda_ = diff
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i in range(iterations):
+                sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+                sin_sigma = np.hypot(cos_u2 * sin_lambda, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+                cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+                sigma = np.arctan2(sin_sigma, cos_sigma)
+                sin_alpha = np.where(sin_sigma > 0, cos_u1 * cos_u2 * sin_lambda / sin_sigma, 0.0)
+                cos2_alpha = 1 - sin_alpha**2
+                cos_2sigma_m = np.where(cos2_alpha > 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha, 0.0)
+                c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+                previous = lambda_
+                lambda_ = diff + (1 - c) * f * sin_alpha * (
+                    sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (2 * cos_2sigma_m**2 - 1)))
+                if np.all(np.abs(lambda_ - previous) < 1e-12):
+                    break
+        u2 = cos2_alpha * (self.semi_major**2 - semi_minor**2) / semi_minor**2
+        a = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        b = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+            cos_sigma * (2 * cos_2sigma_m**2 - 1)
+            - b / 6 * cos_2sigma_m * (4 * sin_sigma**2 - 3) * (4 * cos_2sigma_m**2 - 3)))
+        return semi_minor * a * (sigma - delta_sigma)
+
+    def query(self, geo_breite: float, geo_laenge: float, max_distance: float, k: int) -> list:
+        """Return (position, distance) of the k nearest stations within max_distance."""
+        geo = (float(geo_breite), float(geo_laenge))
+        return self.rank(geo, self.haversine(*geo), max_distance, k)
+
+    def query_many(self, places: list, max_distance: float, k: int, chunk: int = 512) -> List[list]:
+        """Run query for many places (geo_breite, geo_laenge).
+
+        The approximate distances are computed for chunks of places at once.
+        """
+        geo = np.array(places, dtype=np.float64).reshape(-1, 2)
+        list_ = []
+        for start in range(0, len(geo), chunk):
+            part = geo[start:start + chunk]
+            approx = self.haversine(part[:, 0:1], part[:, 1:2])
+            for point, row in zip(part, approx):
+                list_.append(self.rank((float(point[0]), float(point[1])), row, max_distance, k))
+        return list_
+
+    def rank(self, geo: tuple, approx: np.ndarray, max_distance: float, k: int) -> list:
+        """Measure the candidates of the approximate distances exactly and return the k nearest."""
+        candidates = np.flatnonzero(approx <= max_distance * self.tolerance + 0.1)
+        if len(candidates) > k > 0:
+            limit = np.partition(approx[candidates], k - 1)[k - 1]
+            candidates = candidates[approx[candidates] <= limit * self.tolerance + 0.1]
+        list_ = [(int(i), round(x, 1)) for i, x in zip(candidates, self.vincenty(geo, candidates).tolist())]
+        list_ = [x for x in list_ if x[1] <= max_distance]
+        list_.sort(key=lambda x: x[1])
+        return list_[0:k]
+
+
+class JsonFiles():
+    """Process-wide cache of the parsed JSON data files (and of filelist.txt).
+
+    A file is parsed again when its modification time changes, clear() forgets all files.
+    """
+
+    files = {}  # file name -> (modification time, data)
+
+    def get(self, filename: str, convert=None, load=json.load):
+        """Return the content of a JSON file, optionally converted once after parsing.
+
+        load: parser of the open file for other formats than JSON
+        """
+        mtime = os.path.getmtime(filename)
+        entry = JsonFiles.files.get(filename)
+        if entry is None or entry[0] != mtime:
+            with open(filename, "r") as f:
+                data = load(f)
+            entry = (mtime, convert(data) if convert is not None else data)
+            JsonFiles.files[filename] = entry
+        return entry[1]
+
+    def clear(self) -> None:
+        """Reload all files on next use."""
+        JsonFiles.files.clear()
+
 
 class DwdStation():
     """Manage data and meta data of one weather station."""
+
+    __slots__ = [
+        "stations_id", "von_datum", "bis_datum", "stationshoehe", "geo_breite", "geo_laenge",
+        "stationsname", "bundesland", "grid", "distance"
+    ]
     
     def __init__(self, dict_: dict):
         self.stations_id = dict_["Stations_id"]  
@@ -62,34 +257,114 @@ class DwdStation():
     
 
     def set_data(self, df: pd.DataFrame) -> None:
-        """Add the data record to the station"""
-        self.data = df
+        """Index the data record by day of the year, the record itself is not kept."""
+        self.set_grid(YearGrid(df))
+
+    def get_data(self, columns: list = None) -> pd.DataFrame:
+        """Read columns of the station's data which are not in the grid, all by default."""
+        return DwdFile().get_data(self.stations_id, columns)
+
+    def set_grid(self, grid: "YearGrid") -> None:
+        """Add the data indexed by day of the year."""
+        self.grid = grid
     
     def set_distance(self, distance: float) -> None:
         """Add the distance between the station and a place"""
         self.distance = distance
 
 
+class YearGrid():
+    """Arrange the daily values of a station on a (year x day of the year) grid.
+
+    Every day of the year has a fixed slot (29 February included), so the values
+    of one day over all years are a single slice of the grid.
+
+    years -- all years from the first to the last record -> np.ndarray
+    values -- measurements with shape (years, 366, columns) as float32, NaN if missing -> np.ndarray
+    present -- True where the station has a record for the day -> np.ndarray
+
+    The float32 values are rounded back to the decimal values of the DWD
+    (as float64) when they are read with get_values or day.
+    """
+
+    def __init__(self, df: pd.DataFrame, columns: list = VARIABLES):
+        self.columns = list(columns)
+        if df.empty:
+            self.years = np.zeros(0, dtype=np.int32)
+            self.values = np.zeros((0, len(TAGE), len(self.columns)), dtype=np.float32)
+            self.present = np.zeros((0, len(TAGE)), dtype=bool)
+            return
+        datum = df["MESS_DATUM"].to_numpy().astype(np.int32)
+        years = datum // 10000
+        slots = TAG_SLOT[datum % 10000]
+        self.years = np.arange(years.min(), years.max() + 1, dtype=np.int32)
+        rows = years - self.years[0]
+        self.values = np.full((len(self.years), len(TAGE), len(self.columns)), np.NaN, dtype=np.float32)
+        self.values[rows, slots] = df[self.columns].to_numpy(dtype=np.float32, na_value=np.NaN)
+        self.present = np.zeros((len(self.years), len(TAGE)), dtype=bool)
+        self.present[rows, slots] = True
+
+    @classmethod
+    def from_arrays(cls, years: np.ndarray, values: np.ndarray, present: np.ndarray, columns: list = VARIABLES) -> "YearGrid":
+        """Create a grid from arrays stored before."""
+        grid = cls(pd.DataFrame(), columns)
+        grid.years = years
+        grid.values = values.astype(np.float32, copy=False)
+        grid.present = present
+        return grid
+
+    def get_values(self, slots=slice(None)) -> np.ndarray:
+        """Return the values of some days of the year (positions in TAGE) as float64."""
+        return np.round(self.values[:, slots].astype(np.float64), DwdFile.decimals)
+
+    def day(self, monattag: str) -> tuple:
+        """Return the years with a record for the day "MMTT" and their values (years x columns)."""
+        slot = TAG_SLOT[int(monattag)]
+        mask = self.present[:, slot]
+        return self.years[mask], np.round(self.values[mask, slot].astype(np.float64), DwdFile.decimals)
+
+
 class DwdFile():
     """Fetch and clean the historic weather data from the DWD open data server."""
     
     module_dir = os.path.dirname(__file__)  # get current directory
     base_path = "https://opendata.dwd.de/climate_environment/CDC/observations_germany/climate/daily/kl/historical/"
+    recent_path = base_path.replace("/historical/", "/recent/")  # about the last 500 days, updated daily
+    key_columns = ["STATIONS_ID", "MESS_DATUM"]
+    decimals = 3  # the DWD daily values have at most three decimal places
+    locks = {}  # download lock of every station within the process
+    locks_lock = threading.Lock()
 
     def __init__(self):
         self.module_dir = self.module_dir[:-3] + "data"
         
-    def get_data(self, stations_id: int) -> pd.DataFrame: 
-        """Read the raw data from a local file or fetch them from the DWD open data server."""
+    def get_data(self, stations_id: int, columns: list = None) -> pd.DataFrame: 
+        """Read the raw data from a local file or fetch them from the DWD open data server.
+
+        The columnar store is tried first, the gzipped CSV file is only parsed
+        (and then converted, holding the station's lock) when the store does not exist yet.
+        columns: the measurements to read besides the key columns, all by default
+        """
+        with Metrics.timer("read_store"):
+            stored = self.read_store(stations_id, columns)
+            if stored is not None:
+                Metrics.count("store_hit")
+                return self.to_frame(stored)
         shortname = str(stations_id).zfill(5)
         dffilename = os.path.join(self.module_dir,"station_data", shortname + ".csv.gz")
         if os.path.isfile(dffilename):
-            return self.clean_data(pd.read_csv(dffilename))
+            with self.lock(stations_id):
+                if self.read_store(stations_id, []) is None:  # not converted while waiting for the lock
+                    Metrics.count("csv_convert")
+                    with Metrics.timer("csv_convert"):
+                        try:
+                            df = self.clean_data(pd.read_csv(dffilename))
+                        except pd.errors.EmptyDataError:
+                            df = pd.DataFrame()
+                        self.write_store(stations_id, df)
         else:
-            df = self.get_station_file(stations_id)
-            df = self.clean_data(df)
-            df.to_csv(dffilename, index=False, compression="gzip")
-            return df
+            self.download(stations_id)
+        return self.to_frame(self.read_store(stations_id, columns))
 
     def clean_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """Clean the raw weather data."""
@@ -101,52 +376,446 @@ class DwdFile():
             df.MESS_DATUM = df.MESS_DATUM.apply(str)
         return df
 
+    def get_version(self, stations_id: int) -> int:
+        """Return the modification time (ns) of the station's data, 0 if there is none yet.
 
+        The version changes whenever the station's data are written again.
+        """
+        for filename in [
+                os.path.join(self.get_store_path(stations_id), "meta.json"),
+                self.get_store_path(stations_id) + ".csv.gz"]:
+            try:
+                return os.stat(filename).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return 0
 
-    def get_station_file(self, stations_id: int) -> pd.DataFrame:
-        """Extract the raw data from the station's remote zipped data file. 
-        
-        Take the name of the zip file from localy stored an index file. 
+    def get_store_path(self, stations_id: int) -> str:
+        """Return the directory of the station's columnar store."""
+        return os.path.join(self.module_dir, "station_data", str(stations_id).zfill(5))
+
+    def write_store(self, stations_id: int, df: pd.DataFrame, replace: bool = False) -> None:
+        """Write cleaned data as one .npy file per column.
+
+        Keys are stored as int32, measurements as float32 with NaN for missing values.
+        The store is written to a temporary directory of its own and renamed when complete.
+        An existing store is kept unless replace is set.
         """
+        path = self.get_store_path(stations_id)
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".tmp", dir=os.path.dirname(path))
+        columns = []
+        for col in df.columns:
+            if col in self.key_columns:
+                values = pd.to_numeric(df[col]).to_numpy(dtype=np.int32)
+            elif pd.api.types.is_numeric_dtype(df[col]):
+                values = df[col].to_numpy(dtype=np.float32, na_value=np.NaN)
+            else:
+                continue
+            np.save(os.path.join(tmp_path, col + ".npy"), values)
+            columns.append(col)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"columns": columns, "rows": len(df)}, f)
+        if replace and os.path.isdir(path):
+            old_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".old", dir=os.path.dirname(path))
+            os.rename(path, os.path.join(old_path, "store"))
+            shutil.rmtree(old_path)  # mapped files stay readable until they are closed
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path)  # another process was faster
+        StationCache().remove(stations_id)
 
-        file_list = [
-            x for x in open(
-                os.path.join(self.module_dir, "filelist.txt"), "r").
-            read().split("\n")
-        ]
-        filename = next(
-            (x for x in file_list if x[14:19] == str(stations_id).zfill(5)), "")
-        if filename == "":
+    def read_store(self, stations_id: int, columns: list = None) -> Dict[str, np.ndarray]:
+        """Map columns of the station's store into memory, None if there is no store.
+
+        columns: the measurements to map besides the key columns, all by default;
+        columns the station does not have are left out
+        """
+        path = self.get_store_path(stations_id)
+        try:
+            with open(os.path.join(path, "meta.json"), "r") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return {
+            col: np.load(os.path.join(path, col + ".npy"), mmap_mode="r")
+            for col in meta["columns"]
+            if columns is None or col in self.key_columns or col in columns
+        }
+
+    def to_frame(self, columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+        """Build the DataFrame known from clean_data from the stored columns."""
+        if not columns:
             return pd.DataFrame()
+        data = {}
+        for col, values in columns.items():
+            if values.dtype.kind == "f":
+                data[col] = np.round(values.astype(np.float64), self.decimals)
+            else:
+                data[col] = np.asarray(values)
+        return pd.DataFrame(data)
 
-        with urllib.request.urlopen(self.base_path + filename) as response:
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                shutil.copyfileobj(response, tmp_file)
+    def get_filelist(self) -> Dict[int, tuple]:
+        """Return the index file of the remote zip files, parsed once per process.
 
-        archive = zipfile.ZipFile(tmp_file.name, 'r')
-        archive_files = zipfile.ZipFile.namelist(archive)
-        filename = next((x for x in archive_files if x.startswith("pro")), "")
+        Map the station id to the file name and the first and last day
+        ("YYYYMMDD" as int) of the data.
+        """
+        return JsonFiles().get(os.path.join(self.module_dir, "filelist.txt"), load=self.parse_filelist)
+
+    @staticmethod
+    def parse_filelist(f) -> Dict[int, tuple]:
+        """Parse the lines "tageswerte_KL_NNNNN_YYYYMMDD_YYYYMMDD_hist.zip" of filelist.txt."""
+        filelist = {}
+        for filename in f.read().split("\n"):
+            parts = filename.split("_")
+            if len(parts) == 6:
+                filelist[int(parts[2])] = (filename, int(parts[3]), int(parts[4]))
+        return filelist
+
+    def get_bis_datum(self, stations_id: int) -> int:
+        """Return the last day ("YYYYMMDD" as int) of the station's local data, 0 if there are none."""
+        if self.get_version(stations_id) == 0:
+            return 0
+        columns = self.read_store(stations_id, [])
+        if columns is None:
+            self.get_data(stations_id, [])  # convert the csv.gz file
+            columns = self.read_store(stations_id, [])
+        if not columns or len(columns["MESS_DATUM"]) == 0:
+            return 0
+        return int(columns["MESS_DATUM"][-1])
+
+    def get_filename(self, stations_id: int) -> str:
+        """Return the name of the station's remote zip file, "" if there is none."""
+        entry = self.get_filelist().get(stations_id)
+        return "" if entry is None else entry[0]
+
+    def get_station_file(self, stations_id: int) -> pd.DataFrame:
+        """Extract the raw data from the station's remote zipped data file."""
+        filename = self.get_filename(stations_id)
         if filename == "":
             return pd.DataFrame()
-        data = archive.read(filename)
-        with tempfile.TemporaryFile() as fp:
-            fp.write(data)
-            fp.seek(0)
-            df = pd.read_csv(fp, sep=";")
-        return df
+        return StationFetcher(self.base_path).fetch(filename)
+
+    @contextlib.contextmanager
+    def lock(self, stations_id: int):
+        """Hold the station's download lock within the process and across processes.
+
+        Threads wait on a lock per station, processes on an exclusive lock of the
+        file "NNNNN.lock" (not available on Windows, where only threads are locked).
+        """
+        with DwdFile.locks_lock:
+            station_lock = DwdFile.locks.setdefault(stations_id, threading.Lock())
+        with station_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.get_store_path(stations_id) + ".lock", "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def download(self, stations_id: int, refresh: bool = False) -> None:
+        """Fetch, clean and store the data of a station without local data.
+
+        Only one thread or process downloads a station, the others wait for it
+        and find the station's data afterwards. The files appear atomically.
+        refresh: replace existing local data
+        """
+        with Metrics.timer("download"), self.lock(stations_id):
+            if not refresh and self.get_version(stations_id) != 0:
+                return  # fetched while waiting for the lock
+            Metrics.count("download")
+            df = self.clean_data(self.get_station_file(stations_id))
+            dffilename = self.get_store_path(stations_id) + ".csv.gz"
+            tmp_filename = dffilename + ".tmp" + str(os.getpid()) + "-" + str(threading.get_ident())
+            try:
+                df.to_csv(tmp_filename, index=False, compression="gzip")
+                os.replace(tmp_filename, dffilename)
+            finally:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+            self.write_store(stations_id, df, replace=refresh)
+
+    def submit_downloads(self, stations_ids: List[int]) -> list:
+        """Start downloading the stations without local data, return the futures."""
+        fetcher = StationFetcher(self.base_path)
+        return [fetcher.submit(self.download, x) for x in stations_ids if self.get_version(x) == 0]
+
+    def prefetch(self, stations_ids: List[int]) -> None:
+        """Download the stations without local data concurrently."""
+        for future in self.submit_downloads(stations_ids):
+            future.result()
+
+    def get_recent_filename(self, stations_id: int) -> str:
+        """Return the name of the station's zip file in the recent/ directory."""
+        return "tageswerte_KL_{}_akt.zip".format(str(stations_id).zfill(5))
+
+    def update_recent(self, stations_id: int, state: dict = None) -> tuple:
+        """Append the days after the station's last local day from its zip file in recent/.
+
+        The station's store gets the new rows. Stations without local data are not updated (see download),
+        stations without a zip file in recent/ (no longer active) have no new days.
+        state: the station's entry of the previous update, the zip file is only
+        transferred if it changed since then
+        Return the number of appended days and the new state of the station:
+        the validators of the zip file and the last local day ("bis_datum").
+        """
+        state = state or {}
+        if self.get_version(stations_id) == 0:
+            return 0, state
+        if self.read_store(stations_id, []) is None:
+            self.get_data(stations_id, [])  # convert the csv.gz file before taking the lock
+        try:
+            df, validators = StationFetcher(self.recent_path).fetch_if_modified(
+                self.get_recent_filename(stations_id), state)
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+            df, validators = None, {}
+        with self.lock(stations_id):
+            bis_datum = self.get_bis_datum(stations_id)
+            new_state = dict(validators, bis_datum=bis_datum)
+            if df is None or df.empty:
+                return 0, new_state
+            df = self.clean_data(df)
+            df.MESS_DATUM = pd.to_numeric(df.MESS_DATUM)
+            df = df[df.MESS_DATUM > bis_datum].reset_index(drop=True)
+            if df.empty:
+                return 0, new_state
+            # nullable integer columns of clean_data would become object columns in the concatenation
+            df = df.astype({
+                x: np.float32 for x in df.columns
+                if x not in self.key_columns and pd.api.types.is_numeric_dtype(df[x])})
+            self.write_store(stations_id, pd.concat([self.get_data(stations_id), df], ignore_index=True), replace=True)
+            new_state["bis_datum"] = int(df.MESS_DATUM.iloc[-1])
+            return len(df), new_state
+
+    def get_recent_state(self) -> Dict[str, dict]:
+        """Return the states of the last updates from recent/ by station id."""
+        try:
+            with open(os.path.join(self.module_dir, "station_data", "recent.json"), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_recent_state(self, state: Dict[str, dict]) -> None:
+        filename = os.path.join(self.module_dir, "station_data", "recent.json")
+        with open(filename + ".tmp" + str(os.getpid()), "w") as f:
+            json.dump(state, f)
+        os.replace(filename + ".tmp" + str(os.getpid()), filename)
+
+
+class SharedStore():
+    """Read-only file with the grids of the local stations, mapped by every process.
+
+    The file holds the arrays of one station after another, followed by an index
+    (JSON) of their offsets by station id and, in the last 8 bytes, the offset of
+    the index. The processes map the file and share its pages, so the station data
+    take memory once whatever the number of workers. The file is built after the
+    download of stations (manage.py build_shared_store) and replaced atomically,
+    the entry of a station whose data are newer than the entry is ignored.
+    """
+
+    filename = os.path.join(os.path.dirname(__file__), "..", "data", "station_grids.bin")
+    alignment = 64  # bytes, start of every array
+    mapped = None  # (file identity, mmap, index) of the process
+    lock = threading.Lock()
+
+    def build(self, stations_ids: List[int]) -> int:
+        """Write the file of all given stations with local data, return the number of stations."""
+        dwdfile = DwdFile()
+        tmp_filename = self.filename + ".tmp" + str(os.getpid())
+        index = {}
+        with open(tmp_filename, "wb") as f:
+            for x in stations_ids:
+                if dwdfile.get_version(x) == 0:
+                    continue
+                grid = YearGrid(dwdfile.get_data(x, VARIABLES))
+                version = dwdfile.get_version(x)  # a csv.gz file was converted by get_data
+                arrays = dict(years=grid.years, values=grid.values, present=grid.present)
+                entry = {}
+                for name, array in arrays.items():
+                    f.write(b"\0" * (-f.tell() % self.alignment))
+                    entry[name] = [f.tell(), array.dtype.str, list(array.shape)]
+                    f.write(np.ascontiguousarray(array).tobytes())
+                index[str(x)] = {"version": version, "arrays": entry}
+            offset = f.tell()
+            f.write(json.dumps(index).encode())
+            f.write(struct.pack("<Q", offset))
+        os.replace(tmp_filename, self.filename)
+        return len(index)
+
+    def get_mapping(self) -> tuple:
+        """Return the mapped file and its index, mapped again when the file was replaced; None if there is none."""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with SharedStore.lock:
+            if SharedStore.mapped is None or SharedStore.mapped[0] != identity:
+                with open(self.filename, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offset = struct.unpack("<Q", mapped[-8:])[0]
+                SharedStore.mapped = (identity, mapped, json.loads(mapped[offset:-8]))
+            return SharedStore.mapped[1:]
+
+    def load(self, stations_id: int) -> "YearGrid":
+        """Return the grid of a station as views of the mapped file, None if missing or outdated."""
+        mapping = self.get_mapping()
+        if mapping is None:
+            return None
+        mapped, index = mapping
+        entry = index.get(str(stations_id))
+        if entry is None or entry["version"] != DwdFile().get_version(stations_id):
+            return None
+        arrays = {
+            name: np.frombuffer(mapped, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            for name, (offset, dtype, shape) in entry["arrays"].items()
+        }
+        return YearGrid.from_arrays(arrays["years"], arrays["values"], arrays["present"])
+
+
+class StationCache():
+    """Process-wide LRU cache of the grids of loaded stations.
+
+    The cache is bounded by the bytes of its arrays, the least recently used
+    stations are evicted first. An entry is checked against the version of the
+    station's data at most every check_interval seconds and loaded again if it
+    changed, changes within the process remove the entry at once. Stations
+    loaded by warm() before the workers fork (gunicorn --preload) are shared by
+    all workers.
+    """
+
+    max_bytes = 256 * 1024 * 1024
+    check_interval = 60.0  # seconds between two checks of an entry's files
+    entries = OrderedDict()  # stations_id -> [version, checked, grid, size]
+    size = 0
+    stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    lock = threading.Lock()
+
+    def get_version(self, stations_id: int) -> int:
+        """Return the version of the station's data."""
+        return DwdFile().get_version(stations_id)
+
+    def get(self, stations_id: int) -> "YearGrid":
+        """Return the cached grid of a station, None if it is missing or outdated."""
+        with StationCache.lock:
+            entry = StationCache.entries.get(stations_id)
+            if entry is not None:
+                StationCache.entries.move_to_end(stations_id)
+        if entry is not None and time.monotonic() - entry[1] > self.check_interval:
+            if self.get_version(stations_id) == entry[0]:
+                entry[1] = time.monotonic()
+            else:
+                self.remove(stations_id, entry)
+                self.count("invalidations")
+                entry = None
+        self.count("misses" if entry is None else "hits")
+        return None if entry is None else entry[2]
+
+    def load(self, stations_id: int) -> "YearGrid":
+        """Load the grid of a station with local data.
+
+        It is taken from the SharedStore if possible.
+        """
+        version = self.get_version(stations_id)
+        grid = SharedStore().load(stations_id)
+        if grid is not None:
+            self.put(stations_id, version, grid, shared=True)
+            return grid
+        grid = YearGrid(DwdFile().get_data(stations_id, VARIABLES))
+        self.put(stations_id, version, grid)
+        return grid
+
+    def put(self, stations_id: int, version: int, grid: YearGrid, shared: bool = False) -> None:
+        """Add a station, evict the least recently used ones beyond max_bytes.
+
+        shared: the arrays are views of the SharedStore and take no memory of the process
+        """
+        size = 0
+        if not shared:
+            size = grid.years.nbytes + grid.values.nbytes + grid.present.nbytes
+        if size > self.max_bytes:
+            return
+        with StationCache.lock:
+            old = StationCache.entries.pop(stations_id, None)
+            if old is not None:
+                StationCache.size -= old[3]
+            StationCache.entries[stations_id] = [version, time.monotonic(), grid, size]
+            StationCache.size += size
+            while StationCache.size > self.max_bytes:
+                evicted = StationCache.entries.popitem(last=False)[1]
+                StationCache.size -= evicted[3]
+                StationCache.stats["evictions"] += 1
+                Metrics.count("station_cache_evictions")
+
+    def remove(self, stations_id: int, entry: list = None) -> None:
+        """Remove a station (only if it is still the given entry)."""
+        with StationCache.lock:
+            current = StationCache.entries.get(stations_id)
+            if current is not None and (entry is None or current is entry):
+                del StationCache.entries[stations_id]
+                StationCache.size -= current[3]
+
+    def count(self, stat: str) -> None:
+        with StationCache.lock:
+            StationCache.stats[stat] += 1
+        Metrics.count("station_cache_" + stat)
+
+    def warm(self, stations_ids: List[int]) -> int:
+        """Load stations with local data into the cache, return how many were loaded.
+
+        Nothing is downloaded, so the download pool is not started before a fork.
+        """
+        dwdfile = DwdFile()
+        loaded = 0
+        for x in stations_ids:
+            if dwdfile.get_version(x) != 0:
+                self.load(x)
+                loaded += 1
+        return loaded
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return hits, misses, evictions, invalidations, the number of entries and their bytes."""
+        with StationCache.lock:
+            return dict(StationCache.stats, entries=len(StationCache.entries), bytes=StationCache.size)
+
+    def clear(self) -> None:
+        with StationCache.lock:
+            StationCache.entries.clear()
+            StationCache.size = 0
 
 
 class Forecast():
-    """Aggregate the weater data for specific place and day"""
+    """Aggregate the weater data for specific place and day
+
+    The values of the stations are merged with equal weights ("mean") or with
+    inverse distance weights ("idw"). If the height of the place is known, the
+    temperatures and the pressure of every station are shifted to it first.
+    """
 
-    def __init__(self, geo_breite: float, geo_laenge: float, max_distance: float, monattag: str, max_stations: int):
+    weightings = ("mean", "idw")
+    lapse_rates = {"TXK": -0.0065, "TNK": -0.0065, "PM": -0.12}  # change per m of height (K/m, hPa/m)
+
+    def __init__(
+            self, geo_breite: float, geo_laenge: float, max_distance: float, monattag: str, max_stations: int,
+            stations: list = None, weighting: str = "mean", hoehe: float = None):
         """
         geo_breite: geographical latitude of the forecast location (dec)
         geo_laenge: geographical longitude of the forecast location (dec)
         max_distance: Maximum distance of the surveyed measuring stations from the forecast location (in km) 
         monattag: Day of the year for which the weather should be predicted as str "MMTT"
-        max_stations: Maximum number of stations in the vicinity to be included in the forecast (currently =3)
+        max_stations: Maximum number of stations in the vicinity to be included in the forecast
+        stations: the nearest stations if they are known already, stations with a grid are not loaded again
+        weighting: "mean" of the stations or inverse distance weighting "idw"
+        hoehe: height of the location (m) temperatures and pressure are corrected to, None: no correction
         """
+        if weighting not in self.weightings:
+            raise ValueError("unknown weighting '{}', expected one of {}".format(weighting, self.weightings))
         self.ort = ""
         self.tag = None
         self.monat = None
@@ -156,179 +825,354 @@ class Forecast():
         self.series = {}
         self.aggregate = {}
         self.geo = [geo_breite, geo_laenge]
-        dwd = DWD()
-        dwd.get_stations()
-        self.stations = []
-        for e in dwd.stations:
-            distance = dwd.get_distance(self.geo,(e.geo_breite, e.geo_laenge))
-            if distance <= max_distance:
-                station = e
-                station.set_distance(distance)
-                self.stations.append(station)
-        self.stations = sorted(self.stations, key=lambda station: station.distance)
-        if len(self.stations) < max_stations:
-            max_stations = len(self.stations)
-        self.stations = self.stations[0:max_stations]
-        for i in range(0, max_stations):
-            dwdfile = DwdFile()
-            data = dwdfile.get_data(self.stations[i].stations_id)
-            self.stations[i].set_data(data)
+        if stations is None:
+            stations = DWD().nearest(geo_breite, geo_laenge, max_distance, max_stations)
+        self.stations = stations
+        self.load_stations([e for e in self.stations if not hasattr(e, "grid")])
+        self.weights = self.get_distance_weights() if weighting == "idw" else [1.0] * len(self.stations)
+        self.hoehe = hoehe
+        self.offsets = None if hoehe is None else self.get_offsets()
         self.set_date(monattag)
 
+    @staticmethod
+    @timed("load")
+    def load_stations(stations: list) -> None:
+        """Set the grids of the stations from the StationCache, stations not in the cache are loaded."""
+        cache = StationCache()
+        cached = {e.stations_id: cache.get(e.stations_id) for e in stations}
+        DwdFile().prefetch([x for x, entry in cached.items() if entry is None])
+        for e in stations:
+            entry = cached[e.stations_id]
+            if entry is None:
+                entry = cached[e.stations_id] = cache.load(e.stations_id)
+            e.set_grid(entry)
+
+    @classmethod
+    def get_aggregates_for_places(
+            cls, places: list, monattag: str, max_distance: float = 100, max_stations: int = 3,
+            weighting: str = "mean") -> list:
+        """Calculate the aggregates of one day for many places.
+
+        The nearest stations of all places are found in one query, every station
+        is loaded once and places with the same stations share the aggregates
+        (with inverse distance weighting only places at the same distances).
+        Return per place its stations (with the distances to the place) and the aggregates.
+        """
+        nearest = DWD().nearest_many(places, max_distance, max_stations)
+        loaded = {}
+        for stations in nearest:
+            for e in stations:
+                loaded.setdefault(e.stations_id, copy.copy(e))
+        cls.load_stations(list(loaded.values()))
+        aggregates = {}
+        list_ = []
+        for (geo_breite, geo_laenge), stations in zip(places, nearest):
+            key = tuple(e.stations_id for e in stations)
+            if weighting == "idw":
+                key += tuple(e.distance for e in stations)
+            if key not in aggregates:
+                used = [copy.copy(loaded[e.stations_id]) for e in stations]
+                for x, e in zip(used, stations):
+                    x.set_distance(e.distance)
+                fc = cls(geo_breite, geo_laenge, max_distance, monattag, max_stations,
+                         stations=used, weighting=weighting)
+                aggregates[key] = fc.get_aggregates()
+            list_.append({"stations": stations, "aggr": aggregates[key]})
+        return list_
+
     def set_date(self, monattag: str) -> None:
         """Set the day of the year and calculate neighboring days."""
         self.tag = int(monattag[2:4])
         self.monat = int(monattag[0:2])
         self.datum = monattag
-        today = datetime.date.today()
-        date_ = datetime.date(today.year, self.monat, self.tag)
+        self.tagreihe = self.get_tagreihe(monattag)
+
+    @staticmethod
+    def get_tagreihe(monattag: str) -> list:
+        """Return the day "MMTT" with its neighbours."""
+        year = 2000 if monattag == "0229" else 2001  # 29 February is no neighbour of other days
+        date_ = datetime.date(year, int(monattag[0:2]), int(monattag[2:4]))
         yesterday = date_ + datetime.timedelta(days=-1)
+        tagreihe = []
         for i in range(0, 3):
             d = yesterday + datetime.timedelta(days=i)
-            self.tagreihe.append(str(d.month).zfill(2) + str(d.day).zfill(2))
+            tagreihe.append(str(d.month).zfill(2) + str(d.day).zfill(2))
+        return tagreihe
+
+    @staticmethod
+    def get_tage(von: str, bis: str) -> list:
+        """Return the days "MMTT" from von to bis, ranges may span the turn of the year."""
+        first, last = TAG_SLOT[int(von)], TAG_SLOT[int(bis)]
+        if first <= last:
+            return TAGE[first:last + 1]
+        return TAGE[first:] + TAGE[:last + 1]
 
-    def filter(self, df: pd.DataFrame, col: str, monattag: str) -> pd.Series:
+    @timed("filter")
+    def filter(self, station: DwdStation, col: str, monattag: str) -> pd.Series:
         """Filter a named column from a stations data.
         
         Return only values from different years, which were registred for the same day and month. 
         """
-        if not df.empty:
-            newdf = df[df["MESS_DATUM"].str.contains(
-                "\d\d\d\d" + monattag, regex = True)]
-            return pd.Series(newdf[col].values, index = newdf["MESS_DATUM"])
-        else:
-            return pd.Series([np.NaN], index=["2020"+monattag])
+        df = self.select(station, monattag)
+        return pd.Series(df[col].values, index=df.index)
+
+    def select(self, station: DwdStation, monattag: str) -> pd.DataFrame:
+        """Return all measurements of a station for one day over the years.
 
+        The index holds the dates "YYYYMMTT" of the records.
+        """
+        years, values = station.grid.day(monattag)
+        if len(years) == 0:
+            return pd.DataFrame(
+                np.full((1, len(station.grid.columns)), np.NaN),
+                index=["2020" + monattag], columns=station.grid.columns)
+        return pd.DataFrame(
+            values, index=(years * 10000 + int(monattag)).astype(str),
+            columns=station.grid.columns)
+
+    @timed("history")
     def make_history(self) -> List[Dict]:
-        """Create a data object ready for delivery"""
+        """Create a data object ready for delivery.
+
+        Per station the years with a record ("jahre") and the values of each
+        variable in the same order, None if missing.
+        """
         list_ = []
         for e in self.stations:
-            d = {}
+            years, values = e.grid.day(self.datum)
             d = {
                 "stationsname":e.stationsname,
                 "stationshoehe":e.stationshoehe,
                 "bundesland":e.bundesland,
                 "distance":e.distance,
                 "von_datum":e.von_datum,
-                "bis_datum":e.bis_datum
+                "bis_datum":e.bis_datum,
+                "jahre": years.tolist()
                 }
-            d["TXK"] = json.loads(
-                self.filter(e.data, "TXK", self.datum).to_json(orient="split"))
-            d["TNK"] = json.loads(
-                self.filter(e.data, "TNK", self.datum).to_json(orient="split"))
-            d["RSK"] = json.loads(
-                self.filter(e.data, "RSK", self.datum).to_json(orient="split"))
-            d["SDK"] = json.loads(
-                self.filter(e.data, "SDK", self.datum).to_json(orient="split"))
-            d["PM"] = json.loads(
-                self.filter(e.data, "PM", self.datum).to_json(orient="split"))
-            d["UPM"] = json.loads(
-                self.filter(e.data, "UPM", self.datum).to_json(orient="split"))
-            list_.append(d.copy())
-        return list_.copy()
-
-    def get_month(self, monat: int) -> str:
+            columns = values.T.astype(object)
+            columns[np.isnan(values.T)] = None
+            d.update(zip(e.grid.columns, columns.tolist()))
+            list_.append(d)
+        return list_
+
+    @staticmethod
+    def get_month(monat: int) -> str:
         """Return the name of a month."""
         return [
             "Januar", "Februar", "März", "April", "Mai", "Juni", "Juli",
             "August", "September", "Oktober", "November", "Dezember"
         ][int(monat) - 1]
 
+    @timed("aggregate")
     def get_aggregates(self, monattag: str = "") -> dict:
-        """Calculate aggregates from data"""
-        aggregates = {}
-        for e in ["TXK", "TNK", "RSK", "SDK", "PM", "UPM"]:
-            d = {}
-            if monattag == "":
-                list_ = [self.create_timeline(e, t) for t in self.tagreihe]
-                s = sum(list_) / len(list_)
-            else:
-                s = self.create_timeline(e, monattag)
-            if s.count() == 0:
+        """Calculate aggregates from data
+
+        Without monattag the days around the chosen day (tagreihe) are averaged.
+        """
+        tage = self.tagreihe if monattag == "" else [monattag]
+        years, values = self.get_window(tage)
+        self.aggregates = self.compute_aggregates(years, values)
+        return self.aggregates
+
+    @timed("aggregate")
+    def get_aggregates_for_days(self, tage: list) -> Dict[str, dict]:
+        """Calculate the aggregates of several days like get_aggregates.
+
+        The grids are merged once for all days and their neighbours, the means
+        over the windows and the statistics of all days are computed in one step.
+        """
+        windows = [[TAG_SLOT[int(x)] for x in self.get_tagreihe(t)] for t in tage]
+        slots = sorted({x for window in windows for x in window})
+        position = {x: i for i, x in enumerate(slots)}
+        years, values = self.merge_grids(slots)
+        means = values[:, [[position[x] for x in window] for window in windows]].mean(axis=2)
+        return dict(zip(tage, self.compute_aggregates_for_days(years, means)))
+
+    def get_window(self, tage: list, weights: list = None) -> tuple:
+        """Return the years and the mean of each variable over the given days (years x variables).
+
+        A year only has a value if all days of the window have one.
+        """
+        slots = [TAG_SLOT[int(t)] for t in tage]
+        years, values = self.merge_grids(slots, weights)
+        return years, values.mean(axis=1)
+
+    @staticmethod
+    def get_empty_aggregate() -> dict:
+        """Return the aggregates of a variable without any value."""
+        return {
+            "first_year": "",
+            "last_year": "",
+            "mean": "",
+            "mean2010": "",
+            "count": 0,
+            "std": "",
+            "median": "",
+            "max": "",
+            "max_year": "",
+            "min_year": "",
+            "min": "",
+            "zerorain": "",
+            "zerosun": "",
+            "mitteldruck": "",
+            "depressiondays": ""
+        }
+
+    def compute_aggregates(self, years: np.ndarray, values: np.ndarray) -> dict:
+        """Calculate the statistics of all variables in one pass.
+
+        years: the years of the rows of values
+        values: one column per variable in VARIABLES, NaN if missing
+        """
+        return self.compute_aggregates_for_days(years, values[:, None])[0]
+
+    def compute_aggregates_for_days(self, years: np.ndarray, values: np.ndarray) -> List[dict]:
+        """Calculate the statistics of all variables of several days in one pass.
+
+        years: the years of the rows of values
+        values: years x days x variables (VARIABLES), NaN if missing
+        The statistics are reduced over the years for all days at once, the
+        median from the values sorted once. Return the aggregates of every day.
+        """
+        if len(years) == 0:  # no station with data within reach
+            return [{e: self.get_empty_aggregate() for e in VARIABLES} for i in range(values.shape[1])]
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        recent = valid & (years >= 2010)[:, None, None]
+        count2010 = recent.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid, values, 0.0).sum(axis=0) / count
+            mean2010 = np.where(recent, values, 0.0).sum(axis=0) / count2010
+            std = np.sqrt((np.where(valid, values - mean, 0.0)**2).sum(axis=0) / (count - 1))
+        ordered = np.sort(values, axis=0)  # NaN at the end
+        median = (np.take_along_axis(ordered, (np.maximum(count - 1, 0) // 2)[None], axis=0)[0]
+                  + np.take_along_axis(ordered, (count // 2)[None], axis=0)[0]) / 2
+        first = valid.argmax(axis=0)
+        last = len(years) - 1 - valid[::-1].argmax(axis=0)
+        max_pos = np.where(valid, values, -np.inf).argmax(axis=0)
+        min_pos = np.where(valid, values, np.inf).argmin(axis=0)
+        maximum = np.take_along_axis(values, max_pos[None], axis=0)[0]
+        minimum = np.take_along_axis(values, min_pos[None], axis=0)[0]
+        zero = (values == 0.0).sum(axis=0)
+        if self.hoehe is not None:
+            mittelhoehe = self.hoehe  # the values are shifted to this height
+        else:
+            mittelhoehe = sum([x.stationshoehe for x in self.stations]) / len(self.stations)
+        mean_pressure = round(1013.25 * (1 - (0.0065 * mittelhoehe) / 288.15)**5.255,0)   #Barometric formula
+        depression = (values[..., VARIABLES.index("PM")] < mean_pressure).sum(axis=0)
+        # Python numbers of all days, the loop below only builds the dicts
+        years = years.tolist()
+        count, count2010, zero, depression = count.tolist(), count2010.tolist(), zero.tolist(), depression.tolist()
+        mean, mean2010, std = np.round(mean, 0).tolist(), np.round(mean2010, 0).tolist(), np.round(std, 0).tolist()
+        median, maximum, minimum = median.tolist(), np.round(maximum, 1).tolist(), np.round(minimum, 1).tolist()
+        first, last, max_pos, min_pos = first.tolist(), last.tolist(), max_pos.tolist(), min_pos.tolist()
+        list_ = []
+        for j in range(len(count)):
+            aggregates = {}
+            for i, e in enumerate(VARIABLES):
+                if count[j][i] == 0:
+                    aggregates[e] = self.get_empty_aggregate()
+                    continue
                 d = {
-                    "first_year": "",
-                    "last_year": "",
-                    "mean": "",
-                    "mean2010": "",
-                    "count": 0,
-                    "std": "",
-                    "median": "",
-                    "max": "",
-                    "max_year": "",
-                    "min_year": "",
-                    "min": "",
-                    "zerorain": "",
-                    "zerosun": "",
-                    "mitteldruck": "",
-                    "depressiondays": ""
+                    "mean2010": mean2010[j][i] if count2010[j][i] > 0 else "",
+                    "first_year": str(years[first[j][i]]),
+                    "last_year": str(years[last[j][i]]),
+                    "mean": mean[j][i],
+                    "count": count[j][i],
+                    "std": std[j][i],
+                    "median": median[j][i],
+                    "max": maximum[j][i],
+                    "max_year": str(years[max_pos[j][i]]),
+                    "min_year": str(years[min_pos[j][i]]),
+                    "min": minimum[j][i]
                 }
-            else:
-                if "2010" in s.index:
-                    index_2010 = s.index.to_list().index("2010")
-                    d["mean2010"] = round(s[index_2010:][~s.isnull()].mean(), 0)
-                else:
-                    d["mean2010"]=""
-                d["first_year"] = s[~s.isnull()].index[0]
-                d["last_year"] = s[~s.isnull()].index[-1]
-                d["mean"] = round(s[~s.isnull()].mean(), 0)
-                
-                d["count"] = s[~s.isnull()].count()
-                d["std"] = round(s[~s.isnull()].std(), 0)
-                d["median"] = s[~s.isnull()].median()
-                d["max"] = round(s.max(), 1)
-                d["max_year"] = s.index[np.where(s == np.max(s))[0][0]]
-                d["min_year"] = s.index[np.where(s == np.min(s))[0][0]]
-                d["min"] = round(s.min(), 1)
                 if e == "RSK":
-                    d["zerorain"] = s[s == 0.0].count()
+                    d["zerorain"] = zero[j][i]
                 if e == "SDK":
-                    d["zerosun"] = s[s == 0.0].count()
+                    d["zerosun"] = zero[j][i]
                 if e == "PM":
-                    mittelhoehe = sum([x.stationshoehe for x in self.stations]) / len(self.stations)
-                    d["mean_pressure"] = round(1013.25 * (1 - (0.0065 * mittelhoehe) / 288.15)**5.255,0)   #Barometric formula
-                    d["depression_days"] = s[s < d["mean_pressure"]].count()
-            aggregates[e] = d.copy()
-            self.aggregates = aggregates.copy()
-        return aggregates
+                    d["mean_pressure"] = mean_pressure
+                    d["depression_days"] = depression[j]
+                aggregates[e] = d
+            list_.append(aggregates)
+        return list_
 
+    @timed("aggregate")
     def aggregate_over_year(self) -> dict:
-        """Aggregate the date for one place for all days of the year"""
-        oy = {
-            "monattag": [],
-            "TXK": {
-                "mean": [],
-                "std": []
-            },
-            "TNK": {
-                "mean": [],
-                "std": []
-            },
-            "RSK": {
-                "mean": [],
-                "std": []
-            },
-            "SDK": {
-                "mean": [],
-                "std": []
-            },
-            "PM": {
-                "mean": [],
-                "std": []
-            },
-            "UPM": {
-                "mean": [],
-                "std": []
+        """Aggregate the date for one place for all days of the year
+
+        The merged grid (years x days x variables) is reduced over the years
+        in one pass, a day without any value gets "" for mean and std.
+        """
+        years, values = self.merge_grids()
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid, values, 0.0).sum(axis=0) / count
+            deviation = np.where(valid, values - mean, 0.0)
+            std = np.sqrt((deviation**2).sum(axis=0) / (count - 1))
+        oy = {"monattag": list(TAGE)}
+        for i, e in enumerate(VARIABLES):
+            oy[e] = {
+                "mean": [
+                    float(round(m, 0)) if n > 0 else ""
+                    for m, n in zip(mean[:, i], count[:, i])
+                ],
+                "std": [
+                    float(round(x, 0)) if n > 0 else ""
+                    for x, n in zip(std[:, i], count[:, i])
+                ]
             }
-        }
-        for mt in self.monattag_generator():
-            oy["monattag"].append(mt)
-            aggregates = {}
-            aggregates = self.get_aggregates(mt)
-            for e in ["TXK", "TNK", "RSK", "SDK", "PM", "UPM"]:
-                oy[e]["mean"].append(aggregates[e]["mean"])
-                oy[e]["std"].append(aggregates[e]["std"])
         return oy
 
+    def merge_grids(self, slots: slice = slice(None), weights: list = None) -> tuple:
+        """Merge the grids of all stations on a common year axis.
+
+        slots: days of the year to merge (positions in TAGE), all days by default
+        weights: one weight per station for a weighted mean, the weights of the weighting by default
+
+        Return the years and the mean over the stations (years x days x variables),
+        missing values of one station do not hide the values of the others.
+        The values of a station are summed up in place, equal weights skip the multiplication.
+        """
+        if weights is None:
+            weights = self.weights
+        used = [i for i, e in enumerate(self.stations) if len(e.grid.years) > 0]
+        days = len(np.arange(len(TAGE))[slots])
+        if not used:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, days, len(VARIABLES)))
+        grids = [self.stations[i].grid for i in used]
+        first = min(g.years[0] for g in grids)
+        years = np.arange(first, max(g.years[-1] for g in grids) + 1, dtype=np.int32)
+        total = np.zeros((len(years), days, len(VARIABLES)))
+        weight = np.zeros(total.shape)
+        for i, g in zip(used, grids):
+            rows = slice(g.years[0] - first, g.years[-1] - first + 1)
+            values = g.get_values(slots)
+            if self.offsets is not None:
+                values += self.offsets[i]
+            missing = np.isnan(values)
+            values[missing] = 0.0
+            if weights[i] != 1.0:
+                values *= weights[i]
+                total[rows] += values
+                weight[rows] += ~missing * weights[i]
+            else:
+                total[rows] += values
+                weight[rows] += ~missing
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return years, total / weight
+
+    def get_distance_weights(self, power: float = 2) -> list:
+        """Return inverse distance weights for the stations, closer than 1 km counts as 1 km."""
+        return [1 / max(e.distance, 1.0)**power for e in self.stations]
+
+    def get_offsets(self) -> np.ndarray:
+        """Return per station the shift of each variable from its height to self.hoehe (stations x variables)."""
+        rates = np.array([self.lapse_rates.get(x, 0.0) for x in VARIABLES])
+        heights = np.array([e.stationshoehe for e in self.stations], dtype=np.float64)
+        return (self.hoehe - heights)[:, None] * rates
+
     def monattag_generator(self) -> str:
         """Generate all days of a year."""
         for m in range(1, 13):
@@ -339,78 +1183,61 @@ class Forecast():
                     continue
                 yield str(m).zfill(2) + str(t).zfill(2)
 
-    def create_timeline(self, column: str, monattag: str) -> pd.Series:
+    @timed("timeline")
+    def create_timeline(self, column: str, monattag: str, weights: list = None) -> pd.Series:
         """Merge the data from multiple stations into one series.
         
-        Create average values in case of overlaping data.
+        Create (weighted) average values in case of overlaping data, indexed by
+        the years from the first to the last value.
         """
-        d = {}
-        max = 0
-        min = 30000000
-        for e in self.stations:
-            s = self.filter(e.data, column, monattag)
-            for index, value in s.items():
-                if index[4:8] != monattag:
-                    continue
-                if int(index) > max:
-                    max = int(index)
-                if int(index) < min:
-                    min = int(index)
-                if index in d:
-                    d[index].append(value)
-                else:
-                    d[index] = [value]
-        for k, v in d.items():
-            d[k] = sum(v) / len(v)
-        s = pd.Series(
-            d, index=[str(x) for x in range(min, max + 10000, 10000)])
-        list_ = s.index.tolist()
-        list_ = [x[0:4] for x in list_]
-        s.index = list_
-        return s
-
-
-class Plz() -> dict:
+        slot = TAG_SLOT[int(monattag)]
+        years, values = self.merge_grids(slice(slot, slot + 1), weights)
+        values = values[:, 0, VARIABLES.index(column)]
+        found = np.flatnonzero(~np.isnan(values))
+        if len(found) == 0:
+            return pd.Series(dtype=np.float64)
+        rows = slice(found[0], found[-1] + 1)
+        return pd.Series(values[rows], index=years[rows].astype(str))
+
+
+class Plz():
     """Handle ajax queries concerning postal codes. 
     
     Prepare the return value for the jquery.autocomplete element.
     """
     module_dir = os.path.dirname(__file__)  # get current directory
+    limit = 20  # maximum number of suggestions
     
     def __init__(self):
-        f = open(os.path.join(self.module_dir, "../data/plz.json"), "r")
-        self.json = json.load(f)
+        self.index = JsonFiles().get(
+            os.path.join(self.module_dir, "../data/plz.json"), lambda list_: SearchIndex(tuple(list_)))
+        self.json = self.index.entries
 
     def query(self, query: str) -> dict:
         return {
             "query":
             "Unit",
-            "suggestions": [
-                x for x in self.json
-                if x['value'].lower().find(query.lower()) > -1
-            ]
+            "suggestions": self.index.search(query, self.limit)
         }
 
 
 
-class Monattage() -> dict:
+class Monattage():
     """Handle ajax queries concerning date selection.
     
     Prepare the return value for the jquery.autocomplete element.
     """
     module_dir = os.path.dirname(__file__)  # get current directory
+    limit = 31  # all days of a month
 
     def __init__(self):
-        f = open(os.path.join(self.module_dir, "../data/monattage.json"), "r")
-        self.json = json.load(f)
+        self.index = JsonFiles().get(
+            os.path.join(self.module_dir, "../data/monattage.json"), lambda list_: SearchIndex(tuple(list_)))
+        self.json = self.index.entries
 
     def query(self, query: str) -> dict:
         return {
             "query":
             "Unit",
-            "suggestions": [
-                x for x in self.json
-                if x["value"].lower().find(query.lower()) > -1
-            ]
+            "suggestions": self.index.search(query, self.limit)
         }
-
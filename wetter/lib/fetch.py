@@ -0,0 +1,163 @@
+""" Module Fetch
+
+Download zipped station files from the DWD open data server.
+"""
+
+__all__ = []
+__version__ = "0.1"
+__author__ = "U. Jung"
+
+import base64
+import contextvars
+import http.client
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+class StationFetcher():
+    """Fetch and unpack the zipped data files of weather stations.
+
+    Every thread keeps one keep-alive connection per server, the downloads
+    of several stations run in a process-wide thread pool. An archive is
+    written to an anonymous temporary file and its "produkt_*" member is
+    parsed directly from the archive. Proxies are taken from the
+    environment (HTTP_PROXY, HTTPS_PROXY, NO_PROXY) like urllib does.
+    """
+
+    max_workers = 4
+    timeout = 60  # seconds
+    executor = None  # process-wide ThreadPoolExecutor, created on first use
+    connections = threading.local()
+
+    def __init__(self, base_path: str):
+        """
+        base_path: URL of the directory with the zip files, e.g. the DWD "historical/" directory
+        """
+        self.base_path = base_path
+        url = urllib.parse.urlsplit(base_path)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path
+        self.proxy = None
+        proxy = urllib.request.getproxies().get(self.scheme)
+        if proxy and not urllib.request.proxy_bypass(url.hostname or ""):
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            self.proxy = urllib.parse.urlsplit(proxy)
+
+    def get_proxy_headers(self) -> dict:
+        """Return the Proxy-Authorization header of a proxy URL with credentials."""
+        if self.proxy is None or self.proxy.username is None:
+            return {}
+        credentials = "{}:{}".format(
+            urllib.parse.unquote(self.proxy.username), urllib.parse.unquote(self.proxy.password or ""))
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials.encode()).decode("ascii")}
+
+    def get_connection(self, new: bool = False) -> http.client.HTTPConnection:
+        """Return the connection of the current thread to the server."""
+        pool = getattr(StationFetcher.connections, "pool", None)
+        if pool is None:
+            pool = StationFetcher.connections.pool = {}
+        key = (self.scheme, self.netloc)
+        if new or key not in pool:
+            if key in pool:
+                pool[key].close()
+            if self.proxy is None:
+                connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+                pool[key] = connection_class(self.netloc, timeout=self.timeout)
+            elif self.scheme == "https":
+                # TLS to the server through a CONNECT tunnel of the proxy
+                pool[key] = http.client.HTTPSConnection(self.proxy.netloc.rpartition("@")[2], timeout=self.timeout)
+                pool[key].set_tunnel(self.netloc, headers=self.get_proxy_headers())
+            else:
+                pool[key] = http.client.HTTPConnection(self.proxy.netloc.rpartition("@")[2], timeout=self.timeout)
+        return pool[key]
+
+    def download(self, filename: str, fileobj, headers: dict = None) -> http.client.HTTPMessage:
+        """Write the remote file into fileobj and return the response headers.
+
+        A reused connection may have been closed by the server, then the
+        request is repeated once on a new connection.
+        headers: additional request headers; for a conditional request None is
+        returned if the file was not modified
+        """
+        path = self.path + urllib.parse.quote(filename)
+        headers = dict(headers or {})
+        if self.proxy is not None and self.scheme != "https":
+            # a plain HTTP proxy is sent the absolute URL
+            path = "{}://{}{}".format(self.scheme, self.netloc, path)
+            headers.update(self.get_proxy_headers())
+        for attempt in range(2):
+            connection = self.get_connection(new=attempt > 0)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.CannotSendRequest):
+                if attempt > 0:
+                    raise
+                continue
+            if response.status == 304:
+                response.read()
+                return None
+            if response.status != 200:
+                response.read()
+                raise urllib.error.HTTPError(
+                    self.base_path + filename, response.status, response.reason, response.headers, None)
+            shutil.copyfileobj(response, fileobj)
+            return response.headers
+
+    def fetch(self, filename: str) -> pd.DataFrame:
+        """Download a zip file and return its "produkt_*" table, empty if there is none."""
+        with tempfile.TemporaryFile() as tmp_file:
+            self.download(filename, tmp_file)
+            return self.read_product(tmp_file)
+
+    def fetch_if_modified(self, filename: str, validators: dict = None) -> tuple:
+        """Download a zip file unless it is unchanged since an earlier download.
+
+        validators: "etag" and "last_modified" of the earlier download
+        Return the "produkt_*" table, None if the file is unchanged, and the validators of the file.
+        """
+        validators = validators or {}
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        with tempfile.TemporaryFile() as tmp_file:
+            response_headers = self.download(filename, tmp_file, headers)
+            if response_headers is None:
+                return None, validators
+            return self.read_product(tmp_file), {
+                "etag": response_headers.get("ETag", ""),
+                "last_modified": response_headers.get("Last-Modified", "")
+            }
+
+    @staticmethod
+    def read_product(fileobj) -> pd.DataFrame:
+        """Return the "produkt_*" table of a zip file, empty if there is none."""
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj, "r") as archive:
+            member = next((x for x in archive.namelist() if x.startswith("pro")), "")
+            if member == "":
+                return pd.DataFrame()
+            with archive.open(member) as f:
+                return pd.read_csv(f, sep=";")
+
+    def submit(self, function, *args):
+        """Run a function in the process-wide download pool and return its future.
+
+        The function runs in a copy of the caller's context (see metrics.Metrics).
+        """
+        if StationFetcher.executor is None:
+            StationFetcher.executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="station-fetch")
+        return StationFetcher.executor.submit(contextvars.copy_context().run, function, *args)
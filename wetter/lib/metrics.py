@@ -0,0 +1,170 @@
+""" Module Metrics
+
+Timers and counters of the stages of a request, reported as Server-Timing
+header, log line and in the Prometheus text format.
+"""
+
+__all__ = []
+__version__ = "0.1"
+__author__ = "U. Jung"
+
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from typing import Dict
+
+
+class RequestMetrics():
+    """Durations and events of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}  # stage -> seconds
+        self.events = {}  # event -> count
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+
+class Timer():
+    """Context manager adding its duration to a stage."""
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        Metrics.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics():
+    """Process-wide stage timers and event counters.
+
+    Disabled (the default), timer() returns a shared context manager that does
+    nothing and count() returns at once. Enabled, the durations and events are
+    added to the totals of the process and to the RequestMetrics of the current
+    request, a context variable which threads started with run_in_context see as well.
+    Every process (worker) keeps its own totals.
+    """
+
+    enabled = False
+    lock = threading.Lock()
+    stage_seconds = {}  # stage -> seconds
+    stage_calls = {}  # stage -> number of timed calls
+    events = {}  # event -> count
+    current = contextvars.ContextVar("wetter_request_metrics", default=None)
+    disabled_timer = contextlib.nullcontext()
+
+    @classmethod
+    def timer(cls, stage: str):
+        """Return a context manager timing a stage."""
+        if not cls.enabled:
+            return cls.disabled_timer
+        return Timer(stage)
+
+    @classmethod
+    def add_time(cls, stage: str, seconds: float) -> None:
+        with cls.lock:
+            cls.stage_seconds[stage] = cls.stage_seconds.get(stage, 0.0) + seconds
+            cls.stage_calls[stage] = cls.stage_calls.get(stage, 0) + 1
+        request = cls.current.get()
+        if request is not None:
+            request.stages[stage] = request.stages.get(stage, 0.0) + seconds
+
+    @classmethod
+    def count(cls, event: str, n: int = 1) -> None:
+        """Count an event, e.g. a cache hit."""
+        if not cls.enabled:
+            return
+        with cls.lock:
+            cls.events[event] = cls.events.get(event, 0) + n
+        request = cls.current.get()
+        if request is not None:
+            request.events[event] = request.events.get(event, 0) + n
+
+    @classmethod
+    def start_request(cls) -> tuple:
+        """Collect the stages of a new request, return it and the token for end_request."""
+        request = RequestMetrics()
+        return request, cls.current.set(request)
+
+    @classmethod
+    def end_request(cls, token) -> None:
+        cls.current.reset(token)
+
+    @staticmethod
+    def run_in_context(function):
+        """Return the function bound to the current context, for other threads."""
+        return functools.partial(contextvars.copy_context().run, function)
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls.lock:
+            cls.stage_seconds.clear()
+            cls.stage_calls.clear()
+            cls.events.clear()
+
+    @staticmethod
+    def server_timing(request: RequestMetrics) -> str:
+        """Return the value of the Server-Timing header, durations in ms."""
+        entries = ["{};dur={:.1f}".format(k, v * 1000) for k, v in request.stages.items()]
+        entries.append("total;dur={:.1f}".format(request.elapsed() * 1000))
+        return ", ".join(entries)
+
+    @staticmethod
+    def summary(request: RequestMetrics) -> Dict[str, dict]:
+        """Return durations (ms) and events of a request for a structured log line."""
+        return {
+            "ms": round(request.elapsed() * 1000, 1),
+            "stages": {k: round(v * 1000, 1) for k, v in request.stages.items()},
+            "events": dict(request.events)
+        }
+
+    @classmethod
+    def prometheus(cls, gauges: Dict[str, float] = None) -> str:
+        """Return the totals in the Prometheus text exposition format.
+
+        gauges: current values of the process to add, e.g. the size of a cache
+        """
+        with cls.lock:
+            stage_seconds = dict(cls.stage_seconds)
+            stage_calls = dict(cls.stage_calls)
+            events = dict(cls.events)
+        lines = [
+            "# HELP wetter_stage_seconds_total Time spent in a stage.",
+            "# TYPE wetter_stage_seconds_total counter"
+        ]
+        lines += ['wetter_stage_seconds_total{{stage="{}"}} {:.6f}'.format(k, v) for k, v in sorted(stage_seconds.items())]
+        lines += [
+            "# HELP wetter_stage_calls_total Number of timed runs of a stage.",
+            "# TYPE wetter_stage_calls_total counter"
+        ]
+        lines += ['wetter_stage_calls_total{{stage="{}"}} {}'.format(k, v) for k, v in sorted(stage_calls.items())]
+        lines += [
+            "# HELP wetter_events_total Cache hits and misses, downloads and errors.",
+            "# TYPE wetter_events_total counter"
+        ]
+        lines += ['wetter_events_total{{event="{}"}} {}'.format(k, v) for k, v in sorted(events.items())]
+        for k, v in sorted((gauges or {}).items()):
+            lines += ["# TYPE wetter_{} gauge".format(k), "wetter_{} {}".format(k, v)]
+        return "\n".join(lines) + "\n"
+
+
+def timed(stage: str):
+    """Decorator timing every call of a function as a stage."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not Metrics.enabled:
+                return function(*args, **kwargs)
+            with Timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,88 @@
+""" Module Search
+
+Search index for the jquery.autocomplete queries of places and days.
+"""
+
+__all__ = []
+__version__ = "0.1"
+__author__ = "U. Jung"
+
+import re
+from bisect import bisect_left
+
+import numpy as np
+
+
+class SearchIndex():
+    """Find autocomplete entries whose "value" contains the query.
+
+    The values are normalized (lower case, umlauts spelled out) and all their
+    suffixes are kept in sorted lists, so a query is a range of these lists
+    found by bisection. Matches at the start of the value rank before matches
+    at the start of a word and these before all other matches. Postal code
+    ranges like "52062–52080" also match every code within the range, after
+    all other matches and narrow ranges first: the ranges of towns with the
+    same name span thousands of codes (e.g. "Weimar  35096–99441"), pairs
+    wider than max_range only match their own two codes.
+    """
+
+    umlaute = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+    word_start = re.compile(r"(?:^|(?<=[\s\-/(.,]))\w")
+    postal_code = re.compile(r"(\d{5})(?:\s*[–-]\s*(\d{5}))?")
+    max_range = 10000  # the codes of a single town (Hamburg, Wiesbaden) span less
+
+    def __init__(self, entries: tuple):
+        """Build the index.
+
+        entries -- autocomplete entries with a "value" key -> tuple
+        """
+        self.entries = entries
+        keys = [self.normalize(x["value"]) for x in entries]
+        self.levels = [
+            self.sort([(key, i) for i, key in enumerate(keys)]),
+            self.sort([
+                (key[m.start():], i) for i, key in enumerate(keys)
+                for m in self.word_start.finditer(key) if m.start() > 0
+            ]),
+            self.sort([
+                (key[j:], i) for i, key in enumerate(keys) for j in range(1, len(key))
+            ])
+        ]
+        ranges = [
+            (int(m.group(1)), int(m.group(2) or m.group(1)), i)
+            for i, key in enumerate(keys) for m in self.postal_code.finditer(key)
+            if int(m.group(2) or m.group(1)) - int(m.group(1)) < self.max_range
+        ]
+        self.code_from = np.array([x[0] for x in ranges], dtype=np.int32)
+        self.code_to = np.array([x[1] for x in ranges], dtype=np.int32)
+        self.code_entry = np.array([x[2] for x in ranges], dtype=np.int32)
+
+    def normalize(self, text: str) -> str:
+        """Return the text in lower case with umlauts spelled out."""
+        return text.lower().translate(self.umlaute)
+
+    def sort(self, list_: list) -> tuple:
+        """Return the sorted texts and the positions of their entries as separate lists."""
+        list_.sort()
+        return [x[0] for x in list_], [x[1] for x in list_]
+
+    def search(self, query: str, limit: int) -> list:
+        """Return up to limit entries matching the query, best matches first."""
+        query = self.normalize(query.strip())
+        if query == "":
+            return []
+        found = []
+        for texts, positions in self.levels:
+            i = bisect_left(texts, query)
+            while len(found) < limit and i < len(texts) and texts[i].startswith(query):
+                if positions[i] not in found:
+                    found.append(positions[i])
+                i += 1
+        if query.isdigit() and len(query) == 5:
+            code = int(query)
+            within = np.flatnonzero((self.code_from <= code) & (code <= self.code_to))
+            within = within[np.argsort(self.code_to[within] - self.code_from[within], kind="stable")]
+            for i in self.code_entry[within].tolist():
+                if i not in found:
+                    found.append(i)
+        return [self.entries[i] for i in found[0:limit]]
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from wetter.lib.dwd import DwdFile, SharedStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the grids of all stations with local data into one file "
+        "which the worker processes map and share (SharedStore).")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "stations", nargs="*", type=int,
+            help="Ids of the stations to include, all stations with local data by default.")
+
+    def get_station_ids(self) -> list:
+        """Return the ids of all stations with local data."""
+        dwdfile = DwdFile()
+        return [x for x in sorted(dwdfile.get_filelist()) if dwdfile.get_version(x) != 0]
+
+    def handle(self, *args, **options):
+        stations = options["stations"] or self.get_station_ids()
+        count = SharedStore().build(stations)
+        self.stdout.write("{} of {} stations written to {}.".format(count, len(stations), SharedStore.filename))
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wetter.lib.dwd import DWD, DwdFile, SharedStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Download, clean and convert the data of the stations in filelist.txt. "
+        "Stations with local data are skipped, so an interrupted run resumes where it stopped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "stations", nargs="*", type=int,
+            help="Ids of the stations to fetch, all stations of filelist.txt by default.")
+        parser.add_argument(
+            "--bundesland", action="append", default=[],
+            help="Only stations of this federal state (may be repeated).")
+        parser.add_argument(
+            "--bbox", nargs=4, type=float, metavar=("SUED", "WEST", "NORD", "OST"),
+            help="Only stations within this bounding box (dec. degrees).")
+        parser.add_argument(
+            "--aktiv-seit", type=int, metavar="YYYYMMDD",
+            help="Only stations with data until this day or later (bis_datum).")
+        parser.add_argument(
+            "--refresh", action="store_true",
+            help="Also fetch stations whose local data end before the end date in filelist.txt.")
+        parser.add_argument(
+            "--workers", type=int, default=4,
+            help="Number of concurrent downloads (default: 4).")
+        parser.add_argument(
+            "--shared-store", action="store_true",
+            help="Rebuild the file shared by the workers (see build_shared_store) afterwards.")
+
+    def select(self, filelist: dict, options: dict) -> list:
+        """Return the ids of the stations in filelist.txt matching the filters."""
+        ids = options["stations"] or sorted(filelist)
+        ids = [x for x in ids if x in filelist]
+        if not (options["bundesland"] or options["bbox"] or options["aktiv_seit"]):
+            return ids
+        stations = {e.stations_id: e for e in DWD().get_station_tuple()}
+        ids = [x for x in ids if x in stations]
+        if options["bundesland"]:
+            ids = [x for x in ids if stations[x].bundesland in options["bundesland"]]
+        if options["bbox"]:
+            sued, west, nord, ost = options["bbox"]
+            ids = [
+                x for x in ids
+                if sued <= float(stations[x].geo_breite) <= nord
+                and west <= float(stations[x].geo_laenge) <= ost
+            ]
+        if options["aktiv_seit"]:
+            ids = [x for x in ids if stations[x].bis_datum >= options["aktiv_seit"]]
+        return ids
+
+    def is_missing(self, dwdfile: DwdFile, stations_id: int, bis_datum: int, refresh: bool) -> bool:
+        """Check if the station has to be fetched."""
+        if dwdfile.get_version(stations_id) == 0:
+            return True
+        return refresh and dwdfile.get_bis_datum(stations_id) < bis_datum
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+        dwdfile = DwdFile()
+        filelist = dwdfile.get_filelist()
+        selected = self.select(filelist, options)
+        stations = [
+            x for x in selected
+            if self.is_missing(dwdfile, x, filelist[x][2], options["refresh"])
+        ]
+        self.stdout.write("{} of {} stations to fetch.".format(len(stations), len(selected)))
+        failed = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            futures = {
+                pool.submit(dwdfile.download, x, dwdfile.get_version(x) != 0): x for x in stations
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                stations_id = futures[future]
+                try:
+                    future.result()
+                    status = "ok"
+                except Exception as e:
+                    status = "failed ({})".format(e)
+                    failed += 1
+                self.stdout.write("[{}/{}] {}: {}".format(i, len(stations), stations_id, status))
+        self.stdout.write("{} stations fetched, {} failed.".format(len(stations) - failed, failed))
+        if options["shared_store"]:
+            local = [x for x in sorted(filelist) if dwdfile.get_version(x) != 0]
+            count = SharedStore().build(local)
+            self.stdout.write("{} stations written to {}.".format(count, SharedStore.filename))
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wetter.lib.dwd import DwdFile, SharedStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Append the new days of the stations with local data from the recent/ directory of the DWD. "
+        "Only changed zip files are transferred, only the new days are added to the store.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "stations", nargs="*", type=int,
+            help="Ids of the stations to update, all stations with local data by default.")
+        parser.add_argument(
+            "--workers", type=int, default=4,
+            help="Number of concurrent downloads (default: 4).")
+        parser.add_argument(
+            "--shared-store", action="store_true",
+            help="Rebuild the file shared by the workers (see build_shared_store) if days were added.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+        dwdfile = DwdFile()
+        stations = options["stations"] or sorted(dwdfile.get_filelist())
+        stations = [x for x in stations if dwdfile.get_version(x) != 0]
+        state = dwdfile.get_recent_state()
+        days = failed = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            futures = {pool.submit(dwdfile.update_recent, x, state.get(str(x))): x for x in stations}
+            for i, future in enumerate(as_completed(futures), 1):
+                stations_id = futures[future]
+                try:
+                    added, state[str(stations_id)] = future.result()
+                    status = "{} days added".format(added) if added else "up to date"
+                    days += added
+                except Exception as e:
+                    status = "failed ({})".format(e)
+                    failed += 1
+                self.stdout.write("[{}/{}] {}: {}".format(i, len(stations), stations_id, status))
+        dwdfile.write_recent_state(state)
+        self.stdout.write("{} days added, {} stations checked, {} failed.".format(days, len(stations), failed))
+        if options["shared_store"] and days:
+            local = [x for x in sorted(dwdfile.get_filelist()) if dwdfile.get_version(x) != 0]
+            count = SharedStore().build(local)
+            self.stdout.write("{} stations written to {}.".format(count, SharedStore.filename))
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+from whitenoise import middleware as whitenoise
+
+from .lib.metrics import Metrics
+
+logger = logging.getLogger("wetter.metrics")
+
+
+def report(request, response, request_metrics) -> None:
+    """Add the Server-Timing header to the response and log the request's stages as JSON."""
+    response["Server-Timing"] = Metrics.server_timing(request_metrics)
+    Metrics.add_time("request", request_metrics.elapsed())
+    line = dict(path=request.path, status=response.status_code, **Metrics.summary(request_metrics))
+    logger.info(json.dumps(line), extra={"metrics": line})
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Time the stages of every request (settings.METRICS), not installed otherwise."""
+    if not Metrics.enabled:
+        raise MiddlewareNotUsed
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            request_metrics, token = Metrics.start_request()
+            try:
+                response = await get_response(request)
+            finally:
+                Metrics.end_request(token)
+            report(request, response, request_metrics)
+            return response
+    else:
+        def middleware(request):
+            request_metrics, token = Metrics.start_request()
+            try:
+                response = get_response(request)
+            finally:
+                Metrics.end_request(token)
+            report(request, response, request_metrics)
+            return response
+    return middleware
+
+
+class WhiteNoiseMiddleware(whitenoise.WhiteNoiseMiddleware):
+    """WhiteNoise for a synchronous and an asynchronous middleware stack.
+
+    The original middleware is synchronous only, under ASGI Django would run
+    the whole stack below it, the async views included, in the one thread of
+    sync_to_async. Here only requests below STATIC_URL go to a thread to look
+    up and open the file, all other requests are passed on without a switch.
+    It uses attributes of the WhiteNoise version pinned in requirements.txt.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # like django.utils.deprecation.MiddlewareMixin
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        response = None
+        if request.path_info.startswith(self.static_prefix):
+            response = await sync_to_async(self.serve_static, thread_sensitive=False)(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+    def serve_static(self, request):
+        """Return the response of a static file, None if there is no file at the path."""
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        return None if static_file is None else self.serve(static_file, request)
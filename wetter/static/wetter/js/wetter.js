@@ -4,18 +4,15 @@
         /*oydata={{oy}};*/
         vars={"TXK":{}, "TNK":{},"RSK":{},"SDK":{},"PM":{},"UPM":{}};
         //var ii=0;
-        for ( var ii=0; ii<3;ii++){
+        for ( var ii=0; ii<wdata.length;ii++){
           ["TXK", "TNK", "RSK","SDK","PM","UPM"].forEach(
             function createPlot(item,index){
               
               if (typeof wdata[ii][item] !== 'undefined'){
                 
-                ind=[];
-                wdata[ii][item]['index'].forEach(function(item){ind.push(item.slice(0,4))});
-                
                 vars[item][ii]={
-                  /*x:ind,*/
-                  x:wdata[ii][item]['data'],
+                  /*x:wdata[ii].jahre,*/
+                  x:wdata[ii][item],
                   name: wdata[ii]["stationsname"]+"/"+wdata[ii]["bundesland"]+ " ["+wdata[ii]["stationshoehe"]+"m] ("+parseInt(wdata[ii].von_datum/10000) +"-"+ parseInt(wdata[ii].bis_datum/10000) + ")",
                   boxpoints: 'Outliers',
                   jitter: 0.3,
@@ -74,15 +71,15 @@
          for(var j=0; j<wdata.length;j++){
             t_data[j]=[];
             jQuery("#tab-tit"+j).html("<h3>"+wdata[j]["stationsname"]+"</h3>");
-            for(var i=0; i< wdata[j]["TXK"]["index"].length; i++){
+            for(var i=0; i< wdata[j]["jahre"].length; i++){
               t_data[j].push(
-                {"Jahr":wdata[j]["TXK"]["index"][i].slice(0,4),
-                  "TXK":wdata[j]["TXK"]["data"][i]+" °C",
-                  "TNK":wdata[j]["TNK"]["data"][i]+" °C",
-                  "RSK":wdata[j]["RSK"]["data"][i]+" mm",
-                  "SDK":wdata[j]["SDK"]["data"][i]+ " h",
-                  "PM":wdata[j]["PM"]["data"][i] + " hPa",
-                  "UPM":wdata[j]["UPM"]["data"][i] + " %",
+                {"Jahr":wdata[j]["jahre"][i],
+                  "TXK":wdata[j]["TXK"][i]+" °C",
+                  "TNK":wdata[j]["TNK"][i]+" °C",
+                  "RSK":wdata[j]["RSK"][i]+" mm",
+                  "SDK":wdata[j]["SDK"][i]+ " h",
+                  "PM":wdata[j]["PM"][i] + " hPa",
+                  "UPM":wdata[j]["UPM"][i] + " %",
                 }
 
               );
@@ -1,3 +1,1017 @@
-from django.test import TestCase
+import copy
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib.error
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import addModuleCleanup, mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import memcache_key_warnings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from . import views
+from .lib.dwd import (
+    DWD, DwdFile, Forecast, JsonFiles, Monattage, Plz, SharedStore, StationCache, VARIABLES,
+    YearGrid)
+from .lib.fetch import StationFetcher
+from .lib.metrics import Metrics
+from .lib.search import SearchIndex
+from .middleware import WhiteNoiseMiddleware
+
+
+BUNDLED_DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+def patch_data_dir(tmp_dir: str, addCleanup) -> str:
+    """Point the station data and the shared file to tmp_dir and return its data directory."""
+    for patcher in [
+            mock.patch.object(DwdFile, "module_dir", os.path.join(tmp_dir, "lib")),
+            mock.patch.object(SharedStore, "filename", os.path.join(tmp_dir, "station_grids.bin"))]:
+        patcher.start()
+        addCleanup(patcher.stop)
+    data_dir = os.path.join(tmp_dir, "data")
+    os.makedirs(os.path.join(data_dir, "station_data"))
+    shutil.copy(os.path.join(BUNDLED_DATA, "filelist.txt"), data_dir)
+    return data_dir
+
+
+def setUpModule():
+    """Run the tests on a copy of the bundled station data, the working tree stays untouched."""
+    tmp_dir = tempfile.TemporaryDirectory()
+    addModuleCleanup(tmp_dir.cleanup)
+    data_dir = patch_data_dir(tmp_dir.name, addModuleCleanup)
+    for filename in os.listdir(os.path.join(BUNDLED_DATA, "station_data")):
+        if filename.endswith(".csv.gz"):
+            shutil.copy(os.path.join(BUNDLED_DATA, "station_data", filename), os.path.join(data_dir, "station_data"))
+    StationCache().clear()
+    addModuleCleanup(StationCache().clear)
+
+
+class DataDirTestCase(SimpleTestCase):
+    """Give every test an empty data directory of its own.
+
+    bundled_stations: stations whose csv.gz files are copied into the data directory
+    """
+    bundled_stations = ()
+
+    def setUp(self):
+        StationCache().clear()
+        self.addCleanup(StationCache().clear)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.data_dir = patch_data_dir(self.tmp_dir.name, self.addCleanup)
+        for stations_id in self.bundled_stations:
+            self.copy_station(stations_id)
+        self.dwdfile = DwdFile()
+
+    def copy_station(self, stations_id: int) -> None:
+        """Copy the bundled csv.gz file of a station into the data directory."""
+        shutil.copy(
+            os.path.join(BUNDLED_DATA, "station_data", str(stations_id).zfill(5) + ".csv.gz"),
+            os.path.join(self.data_dir, "station_data"))
+
+
+class DwdNearestTests(SimpleTestCase):
+    def test_nearest_matches_geodesic_ranking(self):
+        dwd = DWD()
+        dwd.get_stations()
+        geo = (50.77, 6.08)
+        expected = sorted(
+            ((dwd.get_distance(geo, (e.geo_breite, e.geo_laenge)), e.stations_id)
+             for e in dwd.stations if e.stations_id in DwdFile().get_filelist()), key=lambda x: x[0])
+        expected = [(i, d) for d, i in expected if d <= 100]
+        for k in [3, 20]:
+            stations = DWD().nearest(geo[0], geo[1], 100, k)
+            self.assertEqual([(x.stations_id, x.distance) for x in stations], expected[0:k])
+
+    def test_nearest_respects_max_distance(self):
+        self.assertEqual(DWD().nearest(50.77, 6.08, 1, 3), [])
+        stations = DWD().nearest(50.77, 6.08, 20, 10)
+        self.assertTrue(all(x.distance <= 20 for x in stations))
+
+    def test_nearest_skips_stations_without_data_file(self):
+        station = next(x for x in DWD().get_station_tuple() if x.stations_id == 601)
+        self.assertNotIn(601, DwdFile().get_filelist())
+        stations = DWD().nearest(float(station.geo_breite), float(station.geo_laenge), 100, 3)
+        self.assertEqual(len(stations), 3)
+        self.assertNotIn(601, [x.stations_id for x in stations])
+
+    def test_nearest_returns_copies(self):
+        first = DWD().nearest(50.77, 6.08, 100, 1)[0]
+        first.set_data(pd.DataFrame())
+        self.assertTrue(hasattr(first, "grid"))
+        second = DWD().nearest(50.77, 6.08, 100, 1)[0]
+        self.assertFalse(hasattr(second, "grid"))
+
+
+class DwdFileStoreTests(DataDirTestCase):
+    bundled_stations = (3,)
+
+    def test_store_is_written_from_csv(self):
+        expected = self.dwdfile.clean_data(pd.read_csv(
+            os.path.join(self.data_dir, "station_data", "00003.csv.gz")))
+        self.assertIsNone(self.dwdfile.read_store(3))
+        df = self.dwdfile.get_data(3)
+        self.assertIsNotNone(self.dwdfile.read_store(3))
+        self.assertEqual(df.MESS_DATUM.tolist(), expected.MESS_DATUM.astype(int).tolist())
+        for col in ["TXK", "TNK", "RSK", "SDK", "PM", "UPM"]:
+            np.testing.assert_array_equal(
+                df[col].to_numpy(), expected[col].to_numpy(dtype=np.float64, na_value=np.NaN))
+
+    def test_store_is_used_afterwards(self):
+        self.dwdfile.get_data(3)
+        os.remove(os.path.join(self.data_dir, "station_data", "00003.csv.gz"))
+        self.assertEqual(len(self.dwdfile.get_data(3)), 38440)
+
+    def test_only_requested_columns_are_read(self):
+        all_columns = self.dwdfile.get_data(3)
+        df = self.dwdfile.get_data(3, ["TXK", "PM"])
+        self.assertEqual(list(df.columns), ["STATIONS_ID", "MESS_DATUM", "PM", "TXK"])  # order of the store
+        pd.testing.assert_frame_equal(df, all_columns[list(df.columns)])
+        self.assertEqual(self.dwdfile.read_store(3)["TXK"].dtype, np.float32)
+        self.assertEqual(self.dwdfile.read_store(3)["MESS_DATUM"].dtype, np.int32)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serve the zip files of a StationServer over keep-alive connections."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        body = self.server.files.get(self.path.rsplit("/", 1)[-1])
+        etag = '"{}"'.format(zlib.crc32(body or b""))
+        if body is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(404 if body is None else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, *args):
+        pass
+
+
+class StationServer(ThreadingHTTPServer):
+    """Local stand-in for the DWD open data server."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.files = {}
+        self.clients = []
+        self.base_path = "http://127.0.0.1:{}/kl/historical/".format(self.server_address[1])
+
+    def add_station(self, stations_id: int, days: int, first: int = 0, recent: bool = False) -> str:
+        """Add a zip file in the format of the DWD and return its name.
+
+        The station has the days first to first + days (28 days per month) of 2000,
+        recent adds the zip file of the recent/ directory.
+        """
+        shortname = str(stations_id).zfill(5)
+        lines = ["STATIONS_ID;MESS_DATUM;QN_3;  FX;  FM;QN_4; RSK;RSKF; SDK;SHK_TAG;  NM; VPM;  PM; TMK; UPM; TXK; TNK; TGK;eor"]
+        for i in range(first, first + days):
+            lines.append("{:>11};2000{:02d}{:02d};-999;-999;-999;   3; {:.1f};   4;-999;   0; 6.0; 9.0;1010.0;{:.1f}; 80.0;{:.1f};{:.1f};-999;eor".format(
+                stations_id, 1 + i // 28, 1 + i % 28, i / 10, i, i + 5, i - 5))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("Metadaten_Geographie_{}.txt".format(shortname), "")
+            archive.writestr("produkt_klima_tag_20000101_20001231_{}.txt".format(shortname), "\n".join(lines))
+        filename = "tageswerte_KL_{}_{}.zip".format(shortname, "akt" if recent else "20000101_20001231_hist")
+        self.files[filename] = buffer.getvalue()
+        return filename
+
+
+class StationServerTestCase(DataDirTestCase):
+    """Download the stations 1, 2 and 3 from a local StationServer."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = StationServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        filenames = [self.server.add_station(x, 60) for x in (1, 2, 3)]
+        with open(os.path.join(self.data_dir, "filelist.txt"), "w") as f:
+            f.write("\n".join(filenames) + "\n")
+        for patcher in [
+                mock.patch.object(DwdFile, "base_path", self.server.base_path),
+                mock.patch.object(DwdFile, "recent_path", self.server.base_path.replace("historical", "recent"))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class StationFetcherTests(StationServerTestCase):
+    def test_fetch_parses_the_product_file(self):
+        df = StationFetcher(self.server.base_path).fetch("tageswerte_KL_00002_20000101_20001231_hist.zip")
+        self.assertEqual(len(df), 60)
+        self.assertEqual(df.STATIONS_ID.unique().tolist(), [2])
+
+    def test_filelist_is_parsed_once(self):
+        filelist = self.dwdfile.get_filelist()
+        self.assertEqual(filelist[2], ("tageswerte_KL_00002_20000101_20001231_hist.zip", 20000101, 20001231))
+        self.assertIs(self.dwdfile.get_filelist(), filelist)
+        self.assertEqual(self.dwdfile.get_filename(4), "")
+
+    def test_connection_is_kept_alive(self):
+        fetcher = StationFetcher(self.server.base_path)
+        for filename in self.server.files:
+            fetcher.fetch(filename)
+        self.assertEqual(len(set(self.server.clients)), 1)
+
+    def test_proxy_from_environment(self):
+        proxy = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        environ = {"http_proxy": proxy, "HTTP_PROXY": proxy, "no_proxy": "", "NO_PROXY": ""}
+        with mock.patch.dict(os.environ, environ):
+            fetcher = StationFetcher("http://opendata.invalid/kl/historical/")
+        df = fetcher.fetch("tageswerte_KL_00002_20000101_20001231_hist.zip")
+        self.assertEqual(len(df), 60)
+
+    def test_missing_file_raises_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            StationFetcher(self.server.base_path).fetch("unknown.zip")
+
+    def test_prefetch_stores_all_missing_stations(self):
+        self.dwdfile.prefetch([1, 2, 3])
+        for stations_id in (1, 2, 3):
+            self.assertNotEqual(self.dwdfile.get_version(stations_id), 0)
+            df = self.dwdfile.get_data(stations_id)
+            self.assertEqual(len(df), 60)
+            self.assertEqual(df.TXK.iloc[10], 15.0)
+            self.assertTrue(np.isnan(df.SDK.iloc[10]))
+        self.assertEqual(len(self.server.clients), 3)
+
+    def test_concurrent_downloads_fetch_once(self):
+        threads = [threading.Thread(target=self.dwdfile.download, args=(2,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(len(self.dwdfile.get_data(2)), 60)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.data_dir, "station_data"))),
+            ["00002", "00002.csv.gz", "00002.lock"])
+
+    def test_concurrent_first_loads_convert_once(self):
+        self.copy_station(3)
+        results, errors = [], []
+
+        def load():
+            try:
+                results.append(len(self.dwdfile.get_data(3)))
+            except Exception as e:
+                errors.append(e)
+        with mock.patch.object(DwdFile, "clean_data", autospec=True, side_effect=DwdFile.clean_data) as clean:
+            threads = [threading.Thread(target=load) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(clean.call_count, 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.data_dir, "station_data"))),
+            ["00003", "00003.csv.gz", "00003.lock"])
+
+    def test_station_without_file_is_empty(self):
+        self.assertTrue(self.dwdfile.get_data(4).empty)
+        self.assertEqual(self.server.clients, [])
+
+
+class PrefetchStationsTests(StationServerTestCase):
+    def run_command(self, *args) -> str:
+        out = io.StringIO()
+        call_command("prefetch_stations", *args, stdout=out)
+        return out.getvalue()
+
+    def test_missing_stations_are_fetched_once(self):
+        self.assertIn("3 of 3 stations to fetch.", self.run_command("--workers", "2"))
+        self.assertEqual(len(DwdFile().get_data(2)), 60)
+        self.assertIn("0 of 3 stations to fetch.", self.run_command())
+        self.assertEqual(len(self.server.clients), 3)
+
+    def test_filter_by_bundesland(self):
+        out = self.run_command("--bundesland", "Nordrhein-Westfalen")
+        self.assertIn("1 of 1 stations to fetch.", out)
+        self.assertIn("] 3: ok", out)
+
+    def test_update_from_recent(self):
+        self.run_command("1", "2")
+        self.server.add_station(1, 60, first=40, recent=True)
+        self.server.add_station(2, 30, first=0, recent=True)
+        out = io.StringIO()
+        call_command("update_recent", stdout=out)
+        self.assertIn("] 1: 40 days added", out.getvalue())
+        self.assertIn("] 2: up to date", out.getvalue())
+        self.assertIn("40 days added, 2 stations checked, 0 failed.", out.getvalue())
+        df = DwdFile().get_data(1)
+        self.assertEqual(len(df), 100)
+        self.assertEqual(df.TXK.tolist(), [float(i + 5) for i in range(100)])
+        self.assertEqual(DwdFile().get_recent_state()["1"]["bis_datum"], DwdFile().get_bis_datum(1))
+        requests = len(self.server.clients)
+        call_command("update_recent", stdout=io.StringIO())
+        self.assertEqual(len(self.server.clients), requests + 2)
+        self.assertEqual(len(DwdFile().get_data(1)), 100)
+        self.assertEqual(
+            StationFetcher(self.server.base_path).fetch_if_modified(
+                "tageswerte_KL_00001_akt.zip", DwdFile().get_recent_state()["1"])[0], None)
+
+    def test_station_without_recent_file_is_up_to_date(self):
+        self.run_command("1", "2")
+        self.server.add_station(2, 70, recent=True)
+        out = io.StringIO()
+        call_command("update_recent", stdout=out)
+        self.assertIn("] 1: up to date", out.getvalue())
+        self.assertIn("10 days added, 2 stations checked, 0 failed.", out.getvalue())
+        self.assertEqual(DwdFile().get_recent_state()["1"], {"bis_datum": 20000304})
+
+    def test_refresh_outdated_stations(self):
+        self.run_command("1")
+        self.assertEqual(DwdFile().get_bis_datum(1), 20000304)
+        self.server.add_station(1, 120)
+        self.assertIn("1 of 1 stations to fetch.", self.run_command("1", "--refresh"))
+        self.assertEqual(len(DwdFile().get_data(1)), 120)
+
+    def test_refresh_rewrites_the_csv_file(self):
+        csv_filename = DwdFile().get_store_path(1) + ".csv.gz"
+        pd.DataFrame({"STATIONS_ID": [1], "MESS_DATUM": [20000101], "TXK": [1.0]}).to_csv(csv_filename, index=False)
+        self.server.add_station(1, 120)
+        self.run_command("1", "--refresh")
+        self.assertEqual(len(pd.read_csv(csv_filename)), 120)
+        self.assertEqual(len(DwdFile().get_data(1)), 120)
+
+
+class YearGridTests(SimpleTestCase):
+    def setUp(self):
+        self.forecast = Forecast(50.7827, 6.0941, 1, "0704", 1)
+        self.station = self.forecast.stations[0]
+        self.df = DwdFile().get_data(3)
+
+    def test_day_selects_all_years_of_a_day(self):
+        for monattag in ["0101", "0229", "0704", "1231"]:
+            expected = self.df[self.df.MESS_DATUM % 10000 == int(monattag)]
+            years, values = self.station.grid.day(monattag)
+            np.testing.assert_array_equal(years, expected.MESS_DATUM.to_numpy() // 10000)
+            np.testing.assert_array_equal(values, expected[VARIABLES].to_numpy())
+
+    def test_grid_is_float32_and_other_columns_are_read_on_demand(self):
+        self.assertEqual(self.station.grid.values.dtype, np.float32)
+        self.assertFalse(hasattr(self.station, "data"))
+        df = self.station.get_data(["FX"])
+        np.testing.assert_array_equal(df.FX.to_numpy(), self.df.FX.to_numpy())
+
+    def test_filter_keeps_date_index(self):
+        s = self.forecast.filter(self.station, "TXK", "0704")
+        self.assertEqual(s.index[0], "18910704")
+        self.assertEqual(len(s), len(self.station.grid.day("0704")[0]))
+
+
+class AggregateOverYearTests(SimpleTestCase):
+    def test_matches_per_day_statistics(self):
+        fc = Forecast(50.7827, 6.0941, 1, "0704", 1)
+        oy = fc.aggregate_over_year()
+        self.assertEqual(len(oy["monattag"]), 366)
+        for monattag in ["0101", "0229", "0704"]:
+            i = oy["monattag"].index(monattag)
+            for col in VARIABLES:
+                s = fc.filter(fc.stations[0], col, monattag).dropna()
+                self.assertEqual(oy[col]["mean"][i], round(s.mean(), 0) if len(s) else "")
+                if len(s) > 1:
+                    self.assertEqual(oy[col]["std"][i], round(s.std(), 0))
+
+
+class CreateTimelineTests(SimpleTestCase):
+    def setUp(self):
+        self.fc = Forecast(50.77, 6.08, 100, "0704", 3)
+
+    def frame(self, col: str) -> pd.DataFrame:
+        return pd.concat(
+            [self.fc.filter(e, col, "0704").rename(lambda x: x[0:4]) for e in self.fc.stations],
+            axis=1)
+
+    def test_missing_values_do_not_hide_other_stations(self):
+        df = self.frame("PM")
+        expected = df.mean(axis=1, skipna=True).dropna()
+        s = self.fc.create_timeline("PM", "0704")
+        self.assertEqual(s.index[0], expected.index[0])
+        self.assertEqual(s.index[-1], expected.index[-1])
+        np.testing.assert_allclose(s.dropna(), expected)
+        self.assertGreater(s.count(), df.dropna().shape[0])
+
+    def test_weighted_mean(self):
+        df = self.frame("TXK")
+        weights = self.fc.get_distance_weights()
+        expected = (df * weights).sum(axis=1, min_count=1) / df.notna().mul(weights).sum(axis=1)
+        s = self.fc.create_timeline("TXK", "0704", weights)
+        np.testing.assert_allclose(s.dropna(), expected.dropna())
+
+
+class GetAggregatesTests(SimpleTestCase):
+    def setUp(self):
+        self.fc = Forecast(50.77, 6.08, 100, "0704", 3)
+
+    def test_matches_series_statistics(self):
+        aggregates = self.fc.get_aggregates("0704")
+        for col in VARIABLES:
+            s = self.fc.create_timeline(col, "0704").dropna()
+            d = aggregates[col]
+            self.assertEqual(d["count"], s.count())
+            self.assertEqual((d["first_year"], d["last_year"]), (s.index[0], s.index[-1]))
+            self.assertEqual(d["mean"], round(s.mean(), 0))
+            self.assertEqual(d["mean2010"], round(s[s.index >= "2010"].mean(), 0))
+            self.assertEqual(d["std"], round(s.std(), 0))
+            self.assertEqual(d["median"], s.median())
+            self.assertEqual((d["max"], d["max_year"]), (round(s.max(), 1), s.idxmax()))
+            self.assertEqual((d["min"], d["min_year"]), (round(s.min(), 1), s.idxmin()))
+        self.assertEqual(aggregates["RSK"]["zerorain"], (self.fc.create_timeline("RSK", "0704") == 0).sum())
+        self.assertIn("depression_days", aggregates["PM"])
+
+    def test_window_averages_neighbouring_days(self):
+        self.assertEqual(self.fc.tagreihe, ["0703", "0704", "0705"])
+        aggregates = self.fc.get_aggregates()
+        s = sum(self.fc.create_timeline("TXK", t) for t in self.fc.tagreihe) / 3
+        self.assertEqual(aggregates["TXK"]["count"], s.count())
+        self.assertEqual(aggregates["TXK"]["mean"], round(s.mean(), 0))
+
+    def test_leap_day(self):
+        fc = Forecast(50.77, 6.08, 100, "0229", 3)
+        self.assertEqual(fc.tagreihe, ["0228", "0229", "0301"])
+        self.assertGreater(fc.get_aggregates()["TXK"]["count"], 0)
+        self.assertEqual(Forecast(50.77, 6.08, 100, "0301", 3).tagreihe, ["0228", "0301", "0302"])
+
+
+class EstimationTests(SimpleTestCase):
+    def frame(self, fc: Forecast, col: str) -> pd.DataFrame:
+        return pd.concat([fc.filter(e, col, "0704").rename(lambda x: x[0:4]) for e in fc.stations], axis=1)
+
+    def test_inverse_distance_weighting(self):
+        fc = Forecast(50.77, 6.08, 100, "0704", 3, weighting="idw")
+        weights = [1 / x.distance**2 for x in fc.stations]
+        df = self.frame(fc, "TXK")
+        expected = ((df * weights).sum(axis=1, min_count=1) / df.notna().mul(weights).sum(axis=1)).dropna()
+        np.testing.assert_allclose(fc.create_timeline("TXK", "0704").dropna(), expected)
+        self.assertEqual(fc.get_aggregates("0704")["TXK"]["mean"], round(expected.mean(), 0))
+        plain = Forecast(50.77, 6.08, 100, "0704", 3)
+        self.assertNotEqual(fc.get_aggregates("0704")["TXK"], plain.get_aggregates("0704")["TXK"])
+
+    def test_elevation_correction(self):
+        fc = Forecast(50.77, 6.08, 100, "0704", 3, hoehe=0)
+        heights = [x.stationshoehe for x in fc.stations]
+        df = self.frame(fc, "TXK") + [0.0065 * x for x in heights]
+        np.testing.assert_allclose(fc.create_timeline("TXK", "0704").dropna(), df.mean(axis=1).dropna())
+        df = self.frame(fc, "PM") + [0.12 * x for x in heights]
+        np.testing.assert_allclose(fc.create_timeline("PM", "0704").dropna(), df.mean(axis=1).dropna())
+        plain = Forecast(50.77, 6.08, 100, "0704", 3)
+        pd.testing.assert_series_equal(fc.create_timeline("RSK", "0704"), plain.create_timeline("RSK", "0704"))
+        self.assertEqual(fc.get_aggregates()["PM"]["mean_pressure"], 1013.0)
+
+    def test_no_correction_without_height(self):
+        fc = Forecast(50.77, 6.08, 100, "0704", 3, weighting="idw")
+        self.assertIsNone(fc.offsets)
+        higher = Forecast(50.77, 6.08, 100, "0704", 3, weighting="idw", hoehe=500)
+        self.assertLess(higher.get_aggregates()["TXK"]["mean"], fc.get_aggregates()["TXK"]["mean"])
+
+    def test_more_than_three_stations(self):
+        stations = [x for x in DWD().nearest(51.05, 13.73, 25, 20) if DwdFile().get_version(x.stations_id)]
+        self.assertGreater(len(stations), 3)
+        fc = Forecast(51.05, 13.73, 25, "0704", 20, stations=stations, weighting="idw", hoehe=113)
+        aggregates = fc.get_aggregates()
+        self.assertGreater(aggregates["TXK"]["count"], 0)
+        self.assertEqual(len(fc.make_history()), len(stations))
+
+    def test_unknown_weighting(self):
+        with self.assertRaises(ValueError):
+            Forecast(50.77, 6.08, 100, "0704", 3, weighting="kriging")
+
+
+class JsonFilesTests(SimpleTestCase):
+    def test_parse_once_and_reload_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "x.json")
+            with open(filename, "w") as f:
+                f.write("[1, 2]")
+            first = JsonFiles().get(filename, tuple)
+            self.assertEqual(first, (1, 2))
+            self.assertIs(JsonFiles().get(filename, tuple), first)
+            with open(filename, "w") as f:
+                f.write("[3]")
+            os.utime(filename, (0, os.path.getmtime(filename) + 1))
+            self.assertEqual(JsonFiles().get(filename, tuple), (3,))
+
+    def test_stations_are_shared(self):
+        first, second = DWD(), DWD()
+        first.get_stations()
+        second.get_stations()
+        self.assertIs(first.stations[0], second.stations[0])
+        self.assertIs(first.get_index(), second.get_index())
+
+
+class SearchIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = SearchIndex((
+            {"value": "Aachen  52062–52080", "data": "1"},
+            {"value": "Aach  78267", "data": "2"},
+            {"value": "Bad Aachenau  12345", "data": "3"},
+            {"value": "Gmünd  73525", "data": "4"},
+            {"value": "Schwaach  99999", "data": "5"},
+        ))
+
+    def values(self, query: str, limit: int = 10) -> list:
+        return [x["data"] for x in self.index.search(query, limit)]
+
+    def test_ranking(self):
+        self.assertEqual(self.values("aach"), ["2", "1", "3", "5"])
+        self.assertEqual(self.values("AACH", 2), ["2", "1"])
+
+    def test_umlauts(self):
+        self.assertEqual(self.values("gmünd"), ["4"])
+        self.assertEqual(self.values("gmuend"), ["4"])
+
+    def test_postal_codes(self):
+        self.assertEqual(self.values("52070"), ["1"])
+        self.assertEqual(self.values("5206"), ["1"])
+        self.assertEqual(self.values("52081"), [])
+
+    def test_wide_postal_code_ranges_rank_last(self):
+        index = SearchIndex((
+            {"value": "Weimar  35096–99441", "data": "1"},
+            {"value": "Aachen  52062–52080", "data": "2"},
+            {"value": "Heimbach  52062–55779", "data": "3"},
+            {"value": "Musterhausen  52070", "data": "4"},
+        ))
+        self.assertEqual([x["data"] for x in index.search("52062", 10)], ["2", "3"])
+        self.assertEqual([x["data"] for x in index.search("52070", 10)], ["4", "2", "3"])
+        self.assertEqual([x["data"] for x in index.search("99441", 10)], ["1"])
+        self.assertEqual(
+            [x["value"] for x in Plz().query("52062")["suggestions"]], ["Aachen  52062–52080"])
+
+    def test_substring_and_empty(self):
+        self.assertEqual(self.values("chena"), ["3"])
+        self.assertEqual(self.values(" "), [])
+
+    def test_plz_and_monattage(self):
+        self.assertEqual(Plz().query("Köln")["suggestions"][0]["value"], "Köln  50667–51149")
+        self.assertLessEqual(len(Plz().query("a")["suggestions"]), Plz.limit)
+        self.assertEqual(len(Monattage().query("januar")["suggestions"]), 31)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ApiDatenTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_columnar_payload(self):
+        response = self.client.get("/api/daten/50.77,6.08/0704/")
+        self.assertEqual(response["Content-Type"], "application/json")
+        data = json.loads(response.content)
+        self.assertEqual(data["tag"], 4)
+        self.assertEqual(data["monat"], "Juli")
+        self.assertEqual(set(data["aggr"]), set(VARIABLES))
+        station = data["stations"][0]
+        self.assertEqual(station["stationsname"], "Aachen")
+        self.assertEqual(station["jahre"][0], 1891)
+        for col in VARIABLES:
+            self.assertEqual(len(station[col]), len(station["jahre"]))
+        self.assertIsNone(station["SDK"][0])
+
+    def test_bad_geo(self):
+        self.assertEqual(self.client.get("/api/daten/50.77/0704/").status_code, 400)
+        self.assertEqual(self.client.get("/api/daten/abc,6.08/0704/").status_code, 400)
+        self.assertEqual(self.client.get("/api/daten/nan,6.08/0704/").status_code, 400)
+        self.assertEqual(self.client.get("/api/tage/abc,6.08/?tage=0704").status_code, 400)
+
+    def test_bad_day(self):
+        for monattag in ["1399", "0230"]:
+            self.assertEqual(self.client.get("/api/daten/50.77,6.08/{}/".format(monattag)).status_code, 400)
+
+    async def test_bad_request_async(self):
+        response = await views.api_daten_async(RequestFactory().get("/"), "abc,6.08", "0704")
+        self.assertEqual(response.status_code, 400)
+        response = await views.api_daten_async(RequestFactory().get("/"), "50.77,6.08", "0230")
+        self.assertEqual(response.status_code, 400)
+
+    def test_place_outside_germany(self):
+        data = json.loads(self.client.get("/api/daten/40.0,-3.0/0704/").content)
+        self.assertEqual(data["stations"], [])
+        self.assertEqual(data["aggr"]["TXK"]["count"], 0)
+        data = json.loads(self.client.get("/api/tage/40.0,-3.0/?tage=0101").content)
+        self.assertEqual(data["tage"]["0101"]["PM"]["count"], 0)
+        response = self.client.post(
+            "/api/orte/0704/", json.dumps({"orte": [[50.77, 6.08], [40.0, -3.0]]}), content_type="application/json")
+        orte = json.loads(response.content)["orte"]
+        self.assertGreater(orte[0]["aggr"]["TXK"]["count"], 0)
+        self.assertEqual(orte[1]["aggr"]["TXK"]["count"], 0)
+        response = self.client.get("/daten/40.0,-3.0/0704/")
+        self.assertNotContains(response, "Entschuldigung")
+
+    def test_dumps_writes_nan_as_null(self):
+        self.assertEqual(
+            json.loads(views.dumps({"a": [1.5, float("nan")], "b": {"c": float("inf")}})),
+            {"a": [1.5, None], "b": {"c": None}})
+
+    def test_page_embeds_the_payload_safely(self):
+        payload = views.get_daten("50.77", "6.08", "0704")
+        payload["history"][0]["stationsname"] = "Aachen's </script><b>"
+        response = views.render_daten(RequestFactory().get("/"), ["50.77", "6.08"], payload)
+        content = response.content.decode()
+        start = content.index('<script id="daten-json" type="application/json">') + 48
+        data = json.loads(content[start:content.index("</script>", start)])
+        self.assertEqual(data["stations"][0]["stationsname"], "Aachen's </script><b>")
+
+
+class AggregatesForDaysTests(SimpleTestCase):
+    def test_matches_single_day_forecasts(self):
+        tage = ["0101", "0228", "0229", "0301", "0704", "1231"]
+        batch = Forecast(50.77, 6.08, 100, "0704", 3).get_aggregates_for_days(tage)
+        self.assertEqual(list(batch), tage)
+        for tag in tage:
+            self.assertEqual(batch[tag], Forecast(50.77, 6.08, 100, tag, 3).get_aggregates())
+
+    def test_statistics_of_several_days(self):
+        fc = Forecast(50.77, 6.08, 100, "0704", 3)
+        years = np.arange(2005, 2015, dtype=np.int32)
+        values = np.random.default_rng(1).normal(10, 5, (len(years), 3, len(VARIABLES)))
+        values[[0, 3, 4], 0, 0] = np.NaN  # even number of values
+        values[:, 2, 0] = np.NaN  # no value on the third day
+        aggregates = fc.compute_aggregates_for_days(years, values)
+        self.assertEqual(len(aggregates), 3)
+        for j in range(2):
+            s = pd.Series(values[:, j, 0], index=years.astype(str)).dropna()
+            d = aggregates[j]["TXK"]
+            self.assertEqual(d["count"], s.count())
+            self.assertEqual(d["median"], s.median())
+            self.assertEqual(d["std"], round(s.std(), 0))
+            self.assertEqual(d["mean2010"], round(s[s.index >= "2010"].mean(), 0))
+            self.assertEqual((d["max"], d["max_year"]), (round(s.max(), 1), s.idxmax()))
+            self.assertEqual((d["min"], d["min_year"]), (round(s.min(), 1), s.idxmin()))
+            self.assertEqual(aggregates[j], fc.compute_aggregates(years, values[:, j]))
+        self.assertEqual(aggregates[2]["TXK"], Forecast.get_empty_aggregate())
+        self.assertEqual(aggregates[2]["TNK"]["count"], len(years))
+
+    def test_get_tage_spans_the_turn_of_the_year(self):
+        self.assertEqual(Forecast.get_tage("1230", "0102"), ["1230", "1231", "0101", "0102"])
+        self.assertEqual(len(Forecast.get_tage("0101", "1231")), 366)
+
+    def test_api_tage(self):
+        data = json.loads(self.client.get("/api/tage/50.77,6.08/?von=0701&bis=0714").content)
+        self.assertEqual(len(data["tage"]), 14)
+        self.assertEqual(data["stations"][0]["stationsname"], "Aachen")
+        data = json.loads(self.client.get("/api/tage/50.77,6.08/?tage=0704,0101,0704").content)
+        self.assertEqual(list(data["tage"]), ["0704", "0101"])
+        self.assertEqual(self.client.get("/api/tage/50.77,6.08/?tage=0230").status_code, 400)
+        self.assertEqual(self.client.get("/api/tage/50.77,6.08/").status_code, 400)
+
+
+class AggregatesForPlacesTests(SimpleTestCase):
+    places = [(50.77, 6.08), (50.775, 6.085), (54.80, 9.42), (50.77, 6.08)]
+
+    def setUp(self):
+        StationCache().clear()
+
+    def test_nearest_many_matches_nearest(self):
+        found = DWD().nearest_many(self.places, 100, 3)
+        for (geo_breite, geo_laenge), stations in zip(self.places, found):
+            self.assertEqual(
+                [(x.stations_id, x.distance) for x in stations],
+                [(x.stations_id, x.distance) for x in DWD().nearest(geo_breite, geo_laenge, 100, 3)])
+
+    def test_places_with_the_same_stations_share_the_work(self):
+        with mock.patch.object(Forecast, "get_aggregates", autospec=True,
+                               side_effect=Forecast.get_aggregates) as aggregates, \
+                mock.patch.object(StationCache, "load", autospec=True, side_effect=StationCache.load) as load:
+            results = Forecast.get_aggregates_for_places(self.places, "0704")
+        self.assertEqual(aggregates.call_count, 2)
+        self.assertEqual(load.call_count, 6)
+        self.assertEqual(results[0]["aggr"], Forecast(50.77, 6.08, 100, "0704", 3).get_aggregates())
+        self.assertEqual(results[2]["aggr"], Forecast(54.80, 9.42, 100, "0704", 3).get_aggregates())
+        self.assertNotEqual(results[0]["stations"][0].distance, results[1]["stations"][0].distance)
+
+    def test_inverse_distance_weighting_depends_on_the_place(self):
+        results = Forecast.get_aggregates_for_places(self.places, "0704", weighting="idw")
+        for (geo_breite, geo_laenge), x in zip(self.places, results):
+            fc = Forecast(geo_breite, geo_laenge, 100, "0704", 3, weighting="idw")
+            self.assertEqual(x["aggr"], fc.get_aggregates())
+        self.assertNotEqual(results[0]["aggr"], results[1]["aggr"])
+
+    def test_api_orte(self):
+        response = self.client.post(
+            "/api/orte/0704/", json.dumps({"orte": self.places}), content_type="application/json")
+        data = json.loads(response.content)
+        self.assertEqual(len(data["orte"]), 4)
+        self.assertEqual(data["orte"][2]["stations"][0]["stationsname"], "Flensburg")
+        self.assertEqual(self.client.post(
+            "/api/orte/0704/", "[]", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.post(
+            "/api/orte/0231/", json.dumps({"orte": self.places}), content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.get("/api/orte/0704/").status_code, 405)
+
+    async def test_api_orte_async(self):
+        request = RequestFactory().post(
+            "/api/orte/0704/", json.dumps({"orte": self.places}), content_type="application/json")
+        response = await views.api_orte_async(request, "0704")
+        self.assertEqual(len(json.loads(response.content)["orte"]), 4)
+        response = await views.api_orte_async(RequestFactory().get("/api/orte/0704/"), "0704")
+        self.assertEqual(response.status_code, 405)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class DatenCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_places_with_the_same_stations_share_the_cache(self):
+        with mock.patch("wetter.views.Forecast", wraps=Forecast) as forecast:
+            first = views.get_daten("50.77", "6.08", "0704")
+            second = views.get_daten("50.775", "6.085", "0704")
+            self.assertEqual(forecast.call_count, 1)
+        self.assertEqual(first["aggr"], second["aggr"])
+        self.assertNotEqual(first["history"][0]["distance"], second["history"][0]["distance"])
+        self.assertEqual(
+            [x["distance"] for x in second["history"]], [x.distance for x in second["stations"]])
+
+    def test_converted_stations_are_computed_once(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        data_dir = patch_data_dir(tmp_dir.name, self.addCleanup)
+        StationCache().clear()
+        self.addCleanup(StationCache().clear)
+        stations = DWD().nearest(50.77, 6.08, 100, 3)
+        for x in stations:
+            filename = str(x.stations_id).zfill(5) + ".csv.gz"
+            shutil.copy(os.path.join(BUNDLED_DATA, "station_data", filename), os.path.join(data_dir, "station_data"))
+        key = views.get_daten_key(stations, "0704")
+        with mock.patch("wetter.views.Forecast", wraps=Forecast) as forecast:
+            views.get_daten("50.77", "6.08", "0704")
+            views.get_daten("50.77", "6.08", "0704")
+            self.assertEqual(forecast.call_count, 1)
+        self.assertNotEqual(key, views.get_daten_key(stations, "0704"))
+        self.assertIsNone(cache.get(key))
+
+    def test_unavailable_cache_is_logged_once(self):
+        broken = mock.Mock(**{"get.side_effect": ConnectionError, "set.side_effect": ConnectionError})
+        with mock.patch("wetter.views.cache", broken), mock.patch.object(views, "CACHE_ERRORS", set()):
+            with self.assertLogs("wetter.views", "DEBUG") as logs:
+                views.get_daten("50.77", "6.08", "0704")
+                views.get_daten("50.77", "6.08", "0704")
+        self.assertEqual([x.levelname for x in logs.records], ["WARNING", "DEBUG", "DEBUG", "DEBUG"])
+        self.assertIsNotNone(logs.records[0].exc_info)
+
+    def test_refreshed_station_data_change_the_key(self):
+        stations = DWD().nearest(50.77, 6.08, 100, 3)
+        key = views.get_daten_key(stations, "0704")
+        self.assertEqual(key, views.get_daten_key(stations, "0704"))
+        with mock.patch.object(DwdFile, "get_version", return_value=1):
+            self.assertNotEqual(key, views.get_daten_key(stations, "0704"))
+
+    def test_key_fits_memcached(self):
+        stations = DWD().nearest(51.05, 13.73, 100, 20)
+        with override_settings(DATEN_WEIGHTING="idw"):
+            key = views.get_daten_key(stations, "0704")
+            self.assertEqual(list(memcache_key_warnings(key)), [])
+            self.assertTrue(key.startswith("daten:v4:idw:0704:"))
+            self.assertNotEqual(key, views.get_daten_key(stations[0:19], "0704"))
+
+    def test_estimation_settings(self):
+        mean = views.get_daten("50.77", "6.08", "0704")
+        with override_settings(DATEN_WEIGHTING="idw"):
+            with mock.patch("wetter.views.Forecast", wraps=Forecast) as forecast:
+                idw = views.get_daten("50.77", "6.08", "0704")
+                views.get_daten("50.775", "6.085", "0704")
+                self.assertEqual(forecast.call_count, 2)
+        self.assertNotEqual(idw["aggr"], mean["aggr"])
+        with override_settings(DATEN_STATIONS=2):
+            self.assertEqual(len(views.get_daten("50.77", "6.08", "0704")["history"]), 2)
+
+    async def test_async_and_sync_path_share_the_cache(self):
+        with mock.patch("wetter.views.Forecast", wraps=Forecast) as forecast:
+            first = await views.aget_daten("50.77", "6.08", "0704")
+            second = views.get_daten("50.77", "6.08", "0704")
+            self.assertEqual(forecast.call_count, 1)
+        self.assertEqual(first["aggr"], second["aggr"])
+        self.assertEqual(first["history"], second["history"])
+
+    async def test_daten_async_view(self):
+        request = RequestFactory().get("/daten/50.77,6.08/0704/?ort=Aachen 52062")
+        response = await views.daten_async(request, "50.77,6.08", "0704")
+        self.assertContains(response, "Das Wetter am 4. Juli in Aachen")
+        with self.assertLogs("wetter.views", "ERROR"):
+            response = await views.daten_async(request, "50.77", "0704")
+        self.assertContains(response, "Entschuldigung")
+
+    def test_daten_view(self):
+        response = self.client.get("/daten/50.77,6.08/0704/?ort=Aachen 52062")
+        self.assertContains(response, "Das Wetter am 4. Juli in Aachen")
+        self.assertContains(response, "Roetgen")
+
+    def test_daten_view_has_a_table_per_station(self):
+        nearest = DWD.nearest
+
+        def bundled(dwd, geo_breite, geo_laenge, max_distance, k):
+            stations = nearest(dwd, geo_breite, geo_laenge, max_distance, 20)
+            return [x for x in stations if DwdFile().get_version(x.stations_id)][0:k]
+
+        with override_settings(DATEN_STATIONS=5), mock.patch.object(DWD, "nearest", bundled):
+            response = self.client.get("/daten/51.05,13.73/0704/")
+        self.assertEqual(len(json.loads(response.context["daten_json"])["stations"]), 5)
+        self.assertContains(response, '<table id="tab4">')
+        self.assertNotContains(response, '<table id="tab5">')
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        Metrics.reset()
+        patcher = mock.patch.object(Metrics, "enabled", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs("wetter.metrics", "INFO") as logs:
+            response = self.client.get("/daten/50.77,6.08/0704/")
+            cached = self.client.get("/daten/50.77,6.08/0704/")
+        stages = [x.split(";")[0] for x in response["Server-Timing"].split(", ")]
+        for stage in ["nearest", "cache", "load", "aggregate", "history", "render", "total"]:
+            self.assertIn(stage, stages)
+        self.assertNotIn("load", cached["Server-Timing"])
+        line = json.loads(logs.records[1].getMessage())
+        self.assertEqual(line["path"], "/daten/50.77,6.08/0704/")
+        self.assertEqual(line["events"], {"cache_hit": 1})
+
+    def test_prometheus_endpoint(self):
+        self.client.get("/daten/50.77,6.08/0704/")
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('wetter_events_total{event="cache_miss"} 1', text)
+        self.assertIn('wetter_stage_calls_total{stage="history"} 1', text)
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+    async def test_stages_in_executor_threads_count_for_the_request(self):
+        request_metrics, token = Metrics.start_request()
+        try:
+            await views.aget_daten("50.77", "6.08", "0704")
+        finally:
+            Metrics.end_request(token)
+        self.assertIn("history", request_metrics.stages)
+        self.assertEqual(request_metrics.events["cache_miss"], 1)
+
+    def test_errors_are_logged_and_counted(self):
+        with self.assertLogs("wetter.views", "ERROR") as logs:
+            response = self.client.get("/daten/50.77/0704/")
+        self.assertContains(response, "Entschuldigung")
+        self.assertIn("IndexError", logs.output[0])
+        self.assertEqual(Metrics.events["error"], 1)
+
+    def test_disabled_metrics_record_nothing(self):
+        with mock.patch.object(Metrics, "enabled", False):
+            response = self.client.get("/daten/50.77,6.08/0704/")
+            self.assertNotIn("Server-Timing", response)
+            self.assertEqual(self.client.get("/metrics/").status_code, 404)
+        self.assertEqual(Metrics.stage_calls, {})
+
+
+@override_settings(WHITENOISE_USE_FINDERS=True)
+class WhiteNoiseMiddlewareTests(SimpleTestCase):
+    def test_asgi_stack_runs_without_threads(self):
+        self.assertIn("wetter.middleware.WhiteNoiseMiddleware", settings.MIDDLEWARE)
+        self.assertNotIn("whitenoise.middleware.WhiteNoiseMiddleware", settings.MIDDLEWARE)
+        with mock.patch("django.core.handlers.base.sync_to_async", wraps=sync_to_async) as adapt:
+            ASGIHandler()
+        # only the process_view hooks of sync middleware are adapted, no middleware runs in a thread
+        self.assertEqual({x.args[0].__name__ for x in adapt.call_args_list}, {"process_view"})
+
+    async def test_async_static_files_and_views(self):
+        async def view(request):
+            return HttpResponse("view")
+        middleware = WhiteNoiseMiddleware(view)
+        response = await middleware(RequestFactory().get("/static/wetter/js/util.js"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"function", b"".join(response.streaming_content))
+        response.close()
+        response = await middleware(RequestFactory().get("/daten/50.77,6.08/0704/"))
+        self.assertEqual(response.content, b"view")
+
+    def test_sync_static_files_and_views(self):
+        middleware = WhiteNoiseMiddleware(lambda request: HttpResponse("view"))
+        response = middleware(RequestFactory().get("/static/wetter/js/util.js"))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(middleware(RequestFactory().get("/daten/50.77,6.08/0704/")).content, b"view")
+
+
+class StationCacheTests(DataDirTestCase):
+    bundled_stations = (3,)
+
+    def setUp(self):
+        super().setUp()
+        self.stations = DWD().nearest(50.7827, 6.0941, 1, 1)
+        self.cache = StationCache()
+
+    def test_hit_after_first_load(self):
+        stats = self.cache.get_stats()
+        first = Forecast(50.7827, 6.0941, 1, "0704", 1, stations=copy.deepcopy(self.stations))
+        with mock.patch.object(DwdFile, "get_data") as get_data:
+            second = Forecast(50.7827, 6.0941, 1, "0704", 1, stations=copy.deepcopy(self.stations))
+            get_data.assert_not_called()
+        self.assertIs(first.stations[0].grid, second.stations[0].grid)
+        self.assertEqual(first.get_aggregates(), second.get_aggregates())
+        new = self.cache.get_stats()
+        self.assertEqual((new["misses"] - stats["misses"], new["hits"] - stats["hits"]), (1, 1))
+        self.assertEqual(new["bytes"], first.stations[0].grid.values.nbytes
+                         + first.stations[0].grid.years.nbytes + first.stations[0].grid.present.nbytes)
+
+    def test_least_recently_used_stations_are_evicted(self):
+        grid = YearGrid.from_arrays(
+            np.arange(10, dtype=np.int32), np.zeros((10, 366, 6)), np.ones((10, 366), dtype=bool))
+        size = grid.years.nbytes + grid.values.nbytes + grid.present.nbytes
+        evictions = self.cache.get_stats()["evictions"]
+        with mock.patch.object(StationCache, "max_bytes", 2 * size):
+            self.cache.put(1, (1, 0), grid)
+            self.cache.put(2, (1, 0), grid)
+            self.cache.get(1)
+            self.cache.put(3, (1, 0), grid)
+        self.assertEqual(list(StationCache.entries), [1, 3])
+        self.assertEqual(self.cache.get_stats()["evictions"], evictions + 1)
+        self.assertEqual(self.cache.get_stats()["bytes"], 2 * size)
+
+    def test_changed_station_data_are_loaded_again(self):
+        DwdFile().get_data(3)  # convert the csv.gz file
+        grid = self.cache.load(3)
+        with mock.patch.object(StationCache, "check_interval", 0.0):
+            self.assertIs(self.cache.get(3), grid)
+            DwdFile().write_store(3, DwdFile().get_data(3).iloc[0:100], replace=True)
+            self.assertIsNone(self.cache.get(3))
+        self.assertEqual(len(self.cache.load(3).years), 1)
+
+    def test_warm_loads_only_local_stations(self):
+        self.assertEqual(self.cache.warm([3, 99999]), 1)
+        self.assertEqual(list(StationCache.entries), [3])
+
+
+class SharedStoreTests(DataDirTestCase):
+    bundled_stations = (3, 601, 4240, 15000)
+
+    def setUp(self):
+        super().setUp()
+        self.store = SharedStore()
+
+    def test_build_and_load(self):
+        self.assertIsNone(self.store.load(3))
+        self.assertEqual(self.store.build([3, 601, 99999]), 2)
+        grid = self.store.load(3)
+        expected = YearGrid(DwdFile().get_data(3, VARIABLES))
+        np.testing.assert_array_equal(grid.years, expected.years)
+        np.testing.assert_array_equal(grid.values, expected.values)
+        np.testing.assert_array_equal(grid.present, expected.present)
+        self.assertFalse(grid.values.flags.writeable)
+        self.assertEqual(len(self.store.load(601).years), 0)
+        self.assertIsNone(self.store.load(99999))
+
+    def test_build_converts_csv_files_first(self):
+        self.assertIsNone(DwdFile().read_store(3))
+        self.assertEqual(self.store.build([3]), 1)
+        self.assertIsNotNone(self.store.load(3))
+
+    def test_outdated_stations_are_ignored(self):
+        self.store.build([3])
+        with mock.patch.object(DwdFile, "get_version", return_value=1):
+            self.assertIsNone(self.store.load(3))
+
+    def test_replaced_file_is_mapped_again(self):
+        self.store.build([3])
+        self.assertIsNone(self.store.load(601))
+        self.store.build([3, 601])
+        self.assertIsNotNone(self.store.load(601))
+
+    def test_forecast_maps_the_stations(self):
+        expected = Forecast(50.77, 6.08, 100, "0704", 3)
+        self.store.build([e.stations_id for e in expected.stations])
+        StationCache().clear()
+        with mock.patch.object(DwdFile, "get_data") as get_data:
+            fc = Forecast(50.77, 6.08, 100, "0704", 3)
+            get_data.assert_not_called()
+        self.assertEqual(StationCache().get_stats()["bytes"], 0)
+        self.assertEqual(fc.get_aggregates(), expected.get_aggregates())
+        self.assertEqual(fc.make_history(), expected.make_history())
+        self.assertEqual(fc.aggregate_over_year(), expected.aggregate_over_year())
@@ -6,7 +6,19 @@ from django.conf import settings
 app_name="wetter"
 urlpatterns = [
     path('', views.index, name='index'),
-    path('daten/<geo>/<monattag>/', views.daten, name='daten'),
+    path(
+        'daten/<geo>/<monattag>/',
+        views.daten_async if settings.ASYNC_DATEN else views.daten, name='daten'),
+    path(
+        'api/daten/<geo>/<monattag>/',
+        views.api_daten_async if settings.ASYNC_DATEN else views.api_daten, name='api_daten'),
+    path(
+        'api/tage/<geo>/',
+        views.api_tage_async if settings.ASYNC_DATEN else views.api_tage, name='api_tage'),
+    path(
+        'api/orte/<monattag>/',
+        views.api_orte_async if settings.ASYNC_DATEN else views.api_orte, name='api_orte'),
+    path("metrics/", views.metrics, name='metrics'),
     path("plz/", views.plz, name='plz'),
     path("monattage/", views.monattage, name='monattage')
 ]
@@ -1,60 +1,417 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+import hashlib
+import json
+import logging
+import math
+import os
 import re
-import sys
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.utils.safestring import SafeString
-from .lib.dwd import  Forecast, Plz, Monattage
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .lib.dwd import  DWD, DwdFile, Forecast, Plz, Monattage, StationCache, TAG_SLOT
+from .lib.metrics import Metrics, timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+DATEN_CACHE_TIMEOUT = 60 * 60 * 24  # keys change with the station data anyway
+CACHE_ERRORS = set()  # types of cache errors logged with their traceback
+JSON_SCRIPT_ESCAPES = {ord(">"): "\\u003E", ord("<"): "\\u003C", ord("&"): "\\u0026"}
+MAX_ORTE = 5000  # places per request of api_orte
+MAX_DISTANCE = 100  # km between a place and its stations
+DATEN_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="daten")  # aggregation of daten_async
 
 # Create your view
 def index(request):
     return render(request, 'wetter/index.html')
 
 
-def daten(request, geo, monattag):
+def get_estimation() -> dict:
+    """Return the keyword arguments of Forecast for the configured estimation (settings.DATEN_*)."""
+    return {"weighting": settings.DATEN_WEIGHTING}
+
+
+def get_nearest(geo_breite: str, geo_laenge: str) -> list:
+    """Return the settings.DATEN_STATIONS nearest stations of a place."""
+    return DWD().nearest(geo_breite, geo_laenge, MAX_DISTANCE, settings.DATEN_STATIONS)
+
+
+def get_daten_key(stations: list, monattag: str) -> str:
+    """Return the cache key of a day at a set of stations.
+
+    Nearby places share the key, the versions invalidate it when station data are refreshed.
+    Stations without local data yet have version 0, a payload is written under the key of the loaded stations.
+    With inverse distance weighting the result depends on the distances, they are part of the key.
+    The stations are hashed, memcached keys are limited to 250 characters.
+    """
+    dwdfile = DwdFile()
+    estimation = get_estimation()
+    entries = ["{}@{}".format(x.stations_id, dwdfile.get_version(x.stations_id)) for x in stations]
+    if estimation["weighting"] == "idw":
+        entries = ["{}~{!r}".format(e, x.distance) for e, x in zip(entries, stations)]
+    return "daten:v4:{}:{}:{}".format(
+        estimation["weighting"], monattag, hashlib.sha1(",".join(entries).encode()).hexdigest())
+
+
+def log_cache_error(error: Exception) -> None:
+    """Log an error of the cache backend, with the traceback only the first time it occurs."""
+    if type(error) in CACHE_ERRORS:
+        logger.debug("Cache not available: %r", error)
+    else:
+        CACHE_ERRORS.add(type(error))
+        logger.warning("Cache not available", exc_info=error)
+
+
+def read_cache(key: str) -> dict:
+    """Return the cached payload, None if it is missing or the cache is not available."""
+    try:
+        with Metrics.timer("cache"):
+            payload = cache.get(key)
+    except Exception as e:
+        log_cache_error(e)
+        payload = None
+    Metrics.count("cache_miss" if payload is None else "cache_hit")
+    return payload
+
+
+def write_cache(key: str, payload: dict) -> None:
+    """Cache the payload unless the cache is not available."""
+    try:
+        with Metrics.timer("cache"):
+            cache.set(key, payload, DATEN_CACHE_TIMEOUT)
+    except Exception as e:
+        log_cache_error(e)
+
+
+def compute_daten(geo_breite: str, geo_laenge: str, monattag: str) -> dict:
+    """Compute aggregates and history of a place."""
+    fc = Forecast(geo_breite, geo_laenge, MAX_DISTANCE, monattag, settings.DATEN_STATIONS, **get_estimation())
+    return {
+        "aggr": fc.get_aggregates(),
+        "history": fc.make_history(),
+        "tag": fc.tag,
+        "monat": fc.get_month(fc.monat)
+    }
+
+
+def add_stations(payload: dict, stations: list) -> dict:
+    """Add the stations and their distances to the place to a (shared) payload."""
+    payload = dict(payload, stations=stations)
+    payload["history"] = [
+        dict(d, distance=x.distance) for d, x in zip(payload["history"], stations)]
+    return payload
+
+
+def get_daten(geo_breite: str, geo_laenge: str, monattag: str) -> dict:
+    """Compute aggregates and history of a place or take them from the cache."""
+    stations = get_nearest(geo_breite, geo_laenge)
+    key = get_daten_key(stations, monattag)
+    payload = read_cache(key)
+    if payload is None:
+        payload = compute_daten(geo_breite, geo_laenge, monattag)
+        # downloading or converting the stations changes their versions
+        write_cache(get_daten_key(stations, monattag), payload)
+    return add_stations(payload, stations)
+
+
+async def aget_daten(geo_breite: str, geo_laenge: str, monattag: str) -> dict:
+    """Asynchronous get_daten.
+
+    Cache access and downloads of missing stations are awaited, the aggregation
+    runs in DATEN_EXECUTOR, so the event loop keeps serving other requests.
+    """
+    stations = get_nearest(geo_breite, geo_laenge)
+    key = get_daten_key(stations, monattag)
+    payload = await sync_to_async(read_cache, thread_sensitive=False)(key)
+    if payload is None:
+        await download_stations(stations)
+        payload = await asyncio.get_running_loop().run_in_executor(
+            DATEN_EXECUTOR, Metrics.run_in_context(compute_daten), geo_breite, geo_laenge, monattag)
+        await sync_to_async(write_cache, thread_sensitive=False)(get_daten_key(stations, monattag), payload)
+    return add_stations(payload, stations)
+
+
+async def download_stations(stations: list) -> None:
+    """Wait for the downloads of the stations without local data."""
+    futures = DwdFile().submit_downloads([x.stations_id for x in stations])
+    await asyncio.gather(*[asyncio.wrap_future(x) for x in futures])
+
+
+def is_monattag(text: str) -> bool:
+    """Check if the text is a day "MMTT" of a leap year."""
+    return len(text) == 4 and text.isdigit() and int(text) < len(TAG_SLOT) and TAG_SLOT[int(text)] >= 0
+
+
+def get_geo(geo: str) -> tuple:
+    """Return the place "geoBreite,geoLaenge" of a request as floats."""
+    try:
+        geo_breite, geo_laenge = [float(x) for x in geo.split(",")]
+    except ValueError:
+        raise ValueError("geo must be 'geoBreite,geoLaenge'")
+    if not (abs(geo_breite) <= 90 and abs(geo_laenge) <= 180):  # NaN fails as well
+        raise ValueError("geo must be 'geoBreite,geoLaenge'")
+    return geo_breite, geo_laenge
+
+
+def get_tage(request) -> list:
+    """Return the days of a request, either a list "tage=MMTT,MMTT" or a range "von=MMTT&bis=MMTT"."""
+    if "tage" in request.GET:
+        tage = request.GET["tage"].split(",")
+    else:
+        tage = [request.GET.get("von", ""), request.GET.get("bis", "")]
+    for x in tage:
+        if not is_monattag(x):
+            raise ValueError("invalid day '{}', expected MMTT".format(x))
+    if "tage" in request.GET:
+        return list(dict.fromkeys(tage))
+    return Forecast.get_tage(tage[0], tage[1])
+
+
+def compute_tage(geo_breite: str, geo_laenge: str, tage: list) -> dict:
+    """Compute the aggregates of several days of a place from one load of the stations."""
+    fc = Forecast(geo_breite, geo_laenge, MAX_DISTANCE, tage[0], settings.DATEN_STATIONS, **get_estimation())
+    return {
+        "stations": [{
+            "stationsname": e.stationsname,
+            "stationshoehe": e.stationshoehe,
+            "bundesland": e.bundesland,
+            "distance": e.distance,
+            "von_datum": e.von_datum,
+            "bis_datum": e.bis_datum
+        } for e in fc.stations],
+        "tage": fc.get_aggregates_for_days(tage)
+    }
+
+
+def get_orte(request) -> list:
+    """Return the places (geoBreite, geoLaenge) of the JSON body {"orte": [[geoBreite, geoLaenge], ...]}."""
+    try:
+        orte = json.loads(request.body)["orte"]
+        orte = [(float(x[0]), float(x[1])) for x in orte]
+    except (ValueError, KeyError, TypeError, IndexError):
+        raise ValueError("expected a JSON body {\"orte\": [[geoBreite, geoLaenge], ...]}")
+    if not 0 < len(orte) <= MAX_ORTE:
+        raise ValueError("between 1 and {} places expected".format(MAX_ORTE))
+    return orte
+
+
+def compute_orte(orte: list, monattag: str) -> dict:
+    """Compute the aggregates of one day for many places."""
+    results = Forecast.get_aggregates_for_places(
+        orte, monattag, MAX_DISTANCE, settings.DATEN_STATIONS, **get_estimation())
+    return {
+        "tag": int(monattag[2:4]),
+        "monat": Forecast.get_month(int(monattag[0:2])),
+        "orte": [{
+            "geo": list(geo),
+            "stations": [{
+                "stations_id": e.stations_id,
+                "stationsname": e.stationsname,
+                "distance": e.distance
+            } for e in x["stations"]],
+            "aggr": x["aggr"]
+        } for geo, x in zip(orte, results)]
+    }
+
+
+def replace_nan(data):
+    """Replace NaN and infinite floats in nested dicts and lists by None."""
+    if isinstance(data, float):
+        return data if math.isfinite(data) else None
+    if isinstance(data, dict):
+        return {k: replace_nan(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [replace_nan(x) for x in data]
+    return data
+
+
+@timed("serialize")
+def dumps(data) -> bytes:
+    """Serialize to compact JSON with NaN as null, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(replace_nan(data), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def get_api_payload(payload: dict) -> dict:
+    """Return the part of the payload delivered to the browser.
+
+    Per station the years once and the values of each variable as a list (see Forecast.make_history).
+    """
+    return {
+        "tag": payload["tag"],
+        "monat": payload["monat"],
+        "aggr": payload["aggr"],
+        "stations": payload["history"]
+    }
+
+
+@timed("render")
+def render_daten(request, p1: list, payload: dict):
+    """Render the page of the place p1 = [geoBreite, geoLaenge]."""
     if "ort" in request.GET:
         ort = re.split("\ \d", request.GET['ort'])[0]
     else:
         ort = ""
+    daten_json = dumps(get_api_payload(payload)).decode().translate(JSON_SCRIPT_ESCAPES)
+    heute = date.today()
+    stations = [(x.stationsname, x.bundesland, x.stationshoehe, x.distance)
+                for x in payload["stations"]]
+    if len(set([x[1] for x in stations])) == 1:
+        bundesland = "/" + stations[0][1]
+    else:
+        bundesland = ""
 
+    return render(
+        request, 'wetter/daten.html', {
+            "aggr": payload["aggr"],
+            "geoBreite": p1[0],
+            "geoLaenge": p1[1],
+            "monattag": str(payload["tag"]) + ". " + payload["monat"] + "",
+            "monattatstr": str(payload["tag"]),
+            "ort": ort,
+            "bundesland": bundesland,
+            "daten_json": mark_safe(daten_json),
+            "stationen": stations,
+            "heutetag": heute.day,
+            "heutemonat": Forecast.get_month(heute.month)[0:3],
+            "heutejahr": heute.year
+        })
+
+
+def render_error(request, error: Exception):
+    """Log the error of the daten page and render the start page with a message."""
+    logger.error("daten %s failed", request.path, exc_info=error)
+    Metrics.count("error")
+    msg = "Entschuldigung, das hat leider nicht geklappt. \
+    Wahrscheinlich gab es eine Problem mit der Bereitsstellung der Daten. \
+    Versuche es bitte mit einen anderen Ort. "
+    return render(request, "wetter/index.html", {"error": msg, "err_info": type(error)})
+
+
+def daten(request, geo, monattag):
     p1 = geo.split(",")
     try:
-        fc = Forecast(p1[0], p1[1], 100, monattag, 3)
-        fc.get_aggregates()
-        jstr = SafeString(fc.make_history())
-        jstr = jstr.replace("None", "null")
-        jstr = jstr.replace("'", '"')
-        heute = date.today()
-        stations = [(x.stationsname, x.bundesland, x.stationshoehe, x.distance)
-                    for x in fc.stations]
-        if len(set([x[1] for x in stations])) == 1:
-            bundesland = "/" + stations[0][1]
-        else:
-            bundesland = ""
-
-        return render(
-            request, 'wetter/daten.html', {
-                "aggr": fc.aggregates,
-                "geoBreite": p1[0],
-                "geoLaenge": p1[1],
-                "monattag": str(fc.tag) + ". " + fc.get_month(fc.monat) + "",
-                "monattatstr": str(fc.tag),
-                "ort": ort,
-                "bundesland": bundesland,
-                "history": SafeString(jstr),
-                "stationen": stations,
-                "heutetag": heute.day,
-                "heutemonat": fc.get_month(heute.month)[0:3],
-                "heutejahr": heute.year
-            })
-    except:
-        msg = "Entschuldigung, das hat leider nicht geklappt. \
-        Wahrscheinlich gab es eine Problem mit der Bereitsstellung der Daten. \
-        Versuche es bitte mit einen anderen Ort. "
-        e = sys.exc_info()[0]
-        
-        return render(request, "wetter/index.html", {"error": msg,"err_info":e})
+        payload = get_daten(p1[0], p1[1], monattag)
+        return render_daten(request, p1, payload)
+    except Exception as e:
+        return render_error(request, e)
+
+
+async def daten_async(request, geo, monattag):
+    """Asynchronous daten view, served by the ASGI entry point."""
+    p1 = geo.split(",")
+    try:
+        payload = await aget_daten(p1[0], p1[1], monattag)
+        return render_daten(request, p1, payload)
+    except Exception as e:
+        return render_error(request, e)
+
+
+def api_daten(request, geo, monattag):
+    """Deliver aggregates and history of a place as JSON."""
+    try:
+        p1 = get_geo(geo)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if not is_monattag(monattag):
+        return JsonResponse({"error": "invalid day, expected MMTT"}, status=400)
+    payload = get_daten(p1[0], p1[1], monattag)
+    return HttpResponse(dumps(get_api_payload(payload)), content_type="application/json")
+
+
+async def api_daten_async(request, geo, monattag):
+    """Asynchronous api_daten, served by the ASGI entry point."""
+    try:
+        p1 = get_geo(geo)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if not is_monattag(monattag):
+        return JsonResponse({"error": "invalid day, expected MMTT"}, status=400)
+    payload = await aget_daten(p1[0], p1[1], monattag)
+    return HttpResponse(dumps(get_api_payload(payload)), content_type="application/json")
+
+
+def api_tage(request, geo):
+    """Deliver the aggregates of several days of a place as JSON."""
+    try:
+        tage = get_tage(request)
+        p1 = get_geo(geo)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return HttpResponse(dumps(compute_tage(p1[0], p1[1], tage)), content_type="application/json")
+
+
+async def api_tage_async(request, geo):
+    """Asynchronous api_tage, served by the ASGI entry point."""
+    try:
+        tage = get_tage(request)
+        p1 = get_geo(geo)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    await download_stations(get_nearest(p1[0], p1[1]))
+    data = await asyncio.get_running_loop().run_in_executor(
+        DATEN_EXECUTOR, Metrics.run_in_context(compute_tage), p1[0], p1[1], tage)
+    return HttpResponse(dumps(data), content_type="application/json")
+
+
+@csrf_exempt
+@require_POST
+def api_orte(request, monattag):
+    """Deliver the aggregates of one day for the places posted as JSON."""
+    try:
+        orte = get_orte(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if not is_monattag(monattag):
+        return JsonResponse({"error": "invalid day, expected MMTT"}, status=400)
+    return HttpResponse(dumps(compute_orte(orte, monattag)), content_type="application/json")
+
+
+async def api_orte_async(request, monattag):
+    """Asynchronous api_orte, served by the ASGI entry point."""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        orte = get_orte(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if not is_monattag(monattag):
+        return JsonResponse({"error": "invalid day, expected MMTT"}, status=400)
+    data = await asyncio.get_running_loop().run_in_executor(
+        DATEN_EXECUTOR, Metrics.run_in_context(compute_orte), orte, monattag)
+    return HttpResponse(dumps(data), content_type="application/json")
+
+
+api_orte_async.csrf_exempt = True  # csrf_exempt() would hide the coroutine function before Django 4.1
+
+
+def metrics(request):
+    """Deliver the timers and counters of this process in the Prometheus text format.
+
+    Only available with settings.METRICS and to requests from the local host.
+    """
+    if not Metrics.enabled:
+        raise Http404("metrics are disabled")
+    if request.META.get("REMOTE_ADDR") not in ("127.0.0.1", "::1"):
+        return HttpResponseForbidden()
+    stats = StationCache().get_stats()
+    gauges = {"station_cache_" + x: stats[x] for x in ["entries", "bytes"]}
+    gauges["station_cache_max_bytes"] = StationCache.max_bytes
+    return HttpResponse(Metrics.prometheus(gauges), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def plz(request):